@@ -4,8 +4,9 @@ import time
 import irc
 import irc.client
 import random
-from .base import BaseBotInstance, EmptyBot
-from .bus import MessageBus, MsgDirection
+import threading
+from .base import BaseBotInstance, EmptyBot, SendError
+from .bus import MessageBus, MsgDirection, get_message_bus
 from .models import (
     Message, ChannelType, MessageType, RichText, TextStyle, Color
 )
@@ -26,6 +27,7 @@ class IRCHandle(BaseBotInstance):
 
     def __init__(self, server, port, usessl, nickname, channels, blacklist=[], password=None):
         irc.client.ServerConnection.buffer_class.errors = 'replace'
+        self.send_lock = threading.Lock()
 
         self.nickname = nickname
         self.channels = channels
@@ -153,14 +155,17 @@ class IRCHandle(BaseBotInstance):
         msg = self.rich_message(content, sender=sender, color=color,
                                 reply_quote=reply_quote)
         msg = self.formatRichText(msg)
-        try:
-            self.irc_conn.privmsg(target, msg)
-        except irc.client.ServerNotConnectedError:
-            logger.warning("Server not connected")
-            self.irc_conn.reconnect()
-        except irc.client.InvalidCharacters:
-            logger.warning("Invalid character in msg: %s", repr(msg))
-        time.sleep(0.5)
+        # flood pacing is per connection, so channels take turns
+        with self.send_lock:
+            try:
+                self.irc_conn.privmsg(target, msg)
+            except irc.client.ServerNotConnectedError:
+                logger.warning("Server not connected")
+                self.irc_conn.reconnect()
+                raise SendError("IRC server not connected")
+            except irc.client.InvalidCharacters:
+                logger.warning("Invalid character in msg: %s", repr(msg))
+            time.sleep(0.5)
 
     def formatRichText(self, rich_text: RichText):
         formated_text = ""
@@ -204,15 +209,15 @@ def IRC2FishroomThread(irc_handle: IRCHandle, bus: MessageBus):
 def Fishroom2IRCThread(irc_handle: IRCHandle, bus: MessageBus):
     if irc_handle is None or isinstance(irc_handle, EmptyBot):
         return
-    for msg in bus.message_stream():
-        irc_handle.forward_msg_from_fishroom(msg)
+    irc_handle.forward_msgs_from_bus(bus)
 
 
 def init():
     from .db import get_redis
     redis_client = get_redis()
-    im2fish_bus = MessageBus(redis_client, MsgDirection.im2fish)
-    fish2im_bus = MessageBus(redis_client, MsgDirection.fish2im)
+    im2fish_bus = get_message_bus(redis_client, MsgDirection.im2fish)
+    fish2im_bus = get_message_bus(
+        redis_client, MsgDirection.fish2im, ChannelType.IRC)
 
     irc_channels = [b["irc"] for _, b in config['bindings'].items() if "irc" in b]
     server = config['irc']['server']
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+from importlib import import_module
+
+from .bus import MsgDirection, get_message_bus, get_bus_broker
+from .helpers import get_logger
+from .config import config
+from .db import get_redis
+
+logger = get_logger("AllInOne")
+
+# bridge name -> (module, IM to fishroom thread, fishroom to IM thread)
+BRIDGES = {
+    "irc": ("IRC", "IRC2FishroomThread", "Fishroom2IRCThread"),
+    "telegram": (
+        "telegram", "Telegram2FishroomThread", "Fishroom2TelegramThread"),
+    "xmpp": ("xmpp", "XMPP2FishroomThread", "Fishroom2XMPPThread"),
+    "gitter": ("gitter", "Gitter2FishroomThread", "Fishroom2GitterThread"),
+    "matrix": ("matrix", "Matrix2FishroomThread", "Fishroom2MatrixThread"),
+    "wechat": ("wechat", "Wechat2FishroomThread", "Fishroom2WechatThread"),
+}
+
+
+def RemoteToLocalThread(remote_bus, local_bus):
+    """\
+    Pass on messages published to the redis bus by other processes, like
+    posts from the web interface and API clients
+    """
+    for msg in remote_bus.message_stream():
+        local_bus.publish(msg)
+
+
+def main(bridges):
+    from .runner import run_threads
+
+    redis_client = get_redis()
+    # the web interface still posts over redis
+    remote_bus = get_message_bus(redis_client, MsgDirection.im2fish)
+    broker = get_bus_broker()
+    if broker is not None:
+        broker.serve_in_thread()
+
+    # buses created from now on, including those of the core, are local
+    config.setdefault("bus", {})["backend"] = "local"
+    from . import fishroom as core
+    local_bus = get_message_bus(redis_client, MsgDirection.im2fish)
+
+    threads = [
+        (core.main, ()),
+        (RemoteToLocalThread, (remote_bus, local_bus, ), ),
+    ]
+    for name in bridges:
+        module_name, im2fish_thread, fish2im_thread = BRIDGES[name]
+        module = import_module("." + module_name, package="fishroom")
+        bot, im2fish_bus, fish2im_bus = module.init()
+        threads += [
+            (getattr(module, im2fish_thread), (bot, im2fish_bus, ), ),
+            (getattr(module, fish2im_thread), (bot, fish2im_bus, ), ),
+        ]
+        logger.info("bridge {} started".format(name))
+
+    run_threads(threads)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        "Run fishroom core and IM bridges in one process")
+    parser.add_argument(
+        "bridges", nargs="+", choices=sorted(BRIDGES.keys()),
+        help="IM bridges to start",
+    )
+    args = parser.parse_args()
+
+    main(args.bridges)
+
+# vim: ts=4 sw=4 sts=4 expandtab
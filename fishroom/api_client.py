@@ -1,35 +1,219 @@
 #!/usr/bin/env python
 # -*- coding:utf-8 -*-
 import hashlib
+import threading
+import time
+import unittest
+from collections import namedtuple
+
 from .config import config
+from .helpers import get_logger
+
+logger = get_logger("APIClient")
 
 
 class TokenException(Exception):
     pass
 
 
+class Registry(namedtuple("Registry", ["keys", "names", "rooms", "subscribed"])):
+    """\
+    Snapshot of the API clients
+
+    Attributes:
+        keys: token_id -> key hash
+        names: token_id -> name
+        rooms: token_id -> set of subscribed rooms
+        subscribed: rooms some client subscribes to
+    """
+
+    def is_subscribed(self, token_id, room):
+        rooms = self.rooms.get(token_id, ())
+        return room in rooms or APIClientManager.ALL_ROOMS in rooms
+
+
 class APIClientManager(object):
+    """\
+    API clients and their room subscriptions.
+
+    With cached, the registry of clients is loaded once and kept in memory,
+    and verified tokens are remembered for auth_ttl seconds, so that auth
+    and publish need no redis call. Every change made through a manager is
+    announced on invalidate_channel, on which cached managers drop their
+    copy. While that subscription is down, the registry is read from redis.
+
+    Attributes:
+        r: redis client
+        cached: whether to keep the registry in memory
+    """
 
     clients_key = config["redis"]["prefix"] + ":api_clients"
     clients_name_key = config["redis"]["prefix"] + ":api_clients_name"
-    queue_key = config["redis"]["prefix"] + ":api:{token_id}"
-    max_buffer = 15
+    # messages of a room, shared by all clients, which read it from a cursor
+    log_key = config["redis"]["prefix"] + ":api:log:{room}"
+    cursor_key = config["redis"]["prefix"] + ":api:cursor:{token_id}:{room}"
+    max_log = 1000
+    cursor_ttl = 86400
+    # rooms a client subscribes to, and clients subscribing to a room,
+    # ALL_ROOMS subscribes to every room
+    rooms_key = config["redis"]["prefix"] + ":api_clients_rooms:{token_id}"
+    subscribers_key = config["redis"]["prefix"] + ":api:subscribers:{room}"
+    ALL_ROOMS = "*"
+    # set once clients added before room subscriptions have been migrated
+    scoped_key = config["redis"]["prefix"] + ":api_clients_scoped"
+    invalidate_channel = config["redis"]["prefix"] + ":api_clients:invalidate"
+    auth_ttl = 60
+    max_verified = 1024
+
+    # append to the room log only if some client subscribes to the room,
+    # sent with EVAL, as a registered Script queued on a pipeline costs a
+    # SCRIPT EXISTS round trip of its own
+    PUBLISH_SCRIPT = """
+    if redis.call('SCARD', KEYS[1]) > 0 or redis.call('SCARD', KEYS[2]) > 0 then
+        redis.call('XADD', KEYS[3], 'MAXLEN', '~', ARGV[2], '*', 'msg', ARGV[1])
+    end
+    """
 
-    def __init__(self, r):
+    def __init__(self, r, cached=False):
         self.r = r
+        self.cached = cached
+        self._registry = None
+        self._verified = {}  # (token_id, token_key) -> expiry
+        self._generation = 0
+        self._synced = False
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def publish(self, msg, pipe=None):
+        """\
+        Append msg to the log of its room, unless no client subscribes to
+        it, queue the command on pipe instead of running it if pipe is given
+        """
+        client = pipe if pipe is not None else self.r
+        registry = self.registry()
+        if registry is None:
+            client.eval(
+                self.PUBLISH_SCRIPT, 3,
+                self.subscribers_key.format(room=msg.room),
+                self.subscribers_key.format(room=self.ALL_ROOMS),
+                self.log_key.format(room=msg.room),
+                msg.dumps(), self.max_log,
+            )
+        elif msg.room in registry.subscribed or \
+                self.ALL_ROOMS in registry.subscribed:
+            client.xadd(
+                self.log_key.format(room=msg.room), {"msg": msg.dumps()},
+                maxlen=self.max_log, approximate=True,
+            )
 
-    def publish(self, msg):
-        clients = self.r.hgetall(self.clients_key)
+    def registry(self, load=True):
+        """\
+        The in-memory registry, loaded from redis if it is not yet and load
+        is set. None if not cached, or not loaded.
+        """
+        if not self.cached or not load:
+            return self._registry
+        self._start_sync()
+        registry = self._registry
+        if registry is not None or not self._synced:
+            return registry
+
+        generation = self._generation
+        registry = self._load()
+        with self._lock:
+            # an invalidation during the load may have missed it
+            if generation == self._generation:
+                self._registry = registry
+        return registry
+
+    def _load(self) -> Registry:
         p = self.r.pipeline(transaction=False)
-        for token_id in clients:
-            k = self.queue_key.format(token_id=token_id.decode('utf-8'))
-            p.rpush(k, msg.dumps())
-            p.ltrim(k, -self.max_buffer, -1)
-            p.expire(k, 60)
-        p.execute()
+        p.hgetall(self.clients_key)
+        p.hgetall(self.clients_name_key)
+        keys, names = p.execute()
+        keys = {k.decode('utf-8'): v for k, v in keys.items()}
+        names = {k.decode('utf-8'): v.decode('utf-8')
+                 for k, v in names.items()}
+        for token_id in keys:
+            p.smembers(self.rooms_key.format(token_id=token_id))
+        rooms = {
+            token_id: frozenset(room.decode('utf-8') for room in members)
+            for token_id, members in zip(keys, p.execute())
+        }
+        subscribed = frozenset().union(*rooms.values())
+        return Registry(keys, names, rooms, subscribed)
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._registry = None
+            self._verified = {}
+
+    def _notify(self):
+        self.invalidate()
+        self.r.publish(self.invalidate_channel, "1")
+
+    def _start_sync(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            ready = threading.Event()
+            self._thread = threading.Thread(
+                target=self._sync, args=(ready, ), daemon=True)
+            self._thread.start()
+        # subscribe before the first load, so no change goes unnoticed
+        ready.wait(5)
+
+    def _sync(self, ready):
+        while True:
+            pubsub = self.r.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(self.invalidate_channel)
+                pubsub.get_message(timeout=1)
+                self.invalidate()
+                self._synced = True
+                ready.set()
+                for _ in pubsub.listen():
+                    self.invalidate()
+            except Exception:
+                logger.exception("lost api clients invalidation channel")
+            finally:
+                self._synced = False
+                self.invalidate()
+                ready.set()
+                pubsub.close()
+            time.sleep(1)
 
     def auth(self, token_id, token_key):
-        saved = self.r.hget(self.clients_key, token_id)
+        registry = self.registry()
+        if registry is None:
+            saved = self.r.hget(self.clients_key, token_id)
+            return self.check_key(token_key, saved)
+        return self.verify(registry, token_id, token_key)
+
+    def verify(self, registry, token_id, token_key):
+        """\
+        auth against registry, remembering tokens verified recently
+        """
+        now = time.time()
+        expiry = self._verified.get((token_id, token_key), 0)
+        if expiry > now:
+            return True
+        if not self.check_key(token_key, registry.keys.get(token_id, None)):
+            return False
+        with self._lock:
+            if len(self._verified) >= self.max_verified:
+                self._verified = {}
+            self._verified[(token_id, token_key)] = now + self.auth_ttl
+        return True
+
+    @staticmethod
+    def check_key(token_key, saved):
+        """\
+        Whether token_key matches saved, the hash kept in clients_key
+        """
         if not saved:
             return False
 
@@ -44,7 +228,7 @@ class APIClientManager(object):
         names = [names_map.get(_id, b"nobot").decode('utf-8') for _id in tokens]
         return zip(ids, names)
 
-    def add(self, token_id, token_key, name):
+    def add(self, token_id, token_key, name, rooms=(ALL_ROOMS, )):
         if self.r.hexists(self.clients_key, token_id):
             raise TokenException("Token Id Existed!")
 
@@ -52,18 +236,141 @@ class APIClientManager(object):
         m.update(token_key.encode('utf-8'))
         self.r.hset(self.clients_key, token_id, m.digest())
         self.r.hset(self.clients_name_key, token_id, name)
+        self.subscribe(token_id, rooms)
+        self._notify()
+
+    def get_rooms(self, token_id):
+        return sorted(
+            room.decode('utf-8') for room in
+            self.r.smembers(self.rooms_key.format(token_id=token_id))
+        )
+
+    def is_subscribed(self, token_id, room):
+        registry = self.registry()
+        if registry is not None:
+            return registry.is_subscribed(token_id, room)
+
+        p = self.r.pipeline(transaction=False)
+        rooms_key = self.rooms_key.format(token_id=token_id)
+        p.sismember(rooms_key, room)
+        p.sismember(rooms_key, self.ALL_ROOMS)
+        return any(p.execute())
+
+    def subscribe(self, token_id, rooms):
+        if not rooms:
+            return
+        p = self.r.pipeline(transaction=False)
+        p.sadd(self.rooms_key.format(token_id=token_id), *rooms)
+        for room in rooms:
+            p.sadd(self.subscribers_key.format(room=room), token_id)
+        p.execute()
+        self._notify()
+
+    def unsubscribe(self, token_id, rooms):
+        if not rooms:
+            return
+        p = self.r.pipeline(transaction=False)
+        p.srem(self.rooms_key.format(token_id=token_id), *rooms)
+        for room in rooms:
+            p.srem(self.subscribers_key.format(room=room), token_id)
+        p.execute()
+        self._notify()
+
+    def subscribe_unscoped(self):
+        """\
+        Subscribe clients added before room subscriptions existed to all
+        rooms, so that they keep receiving messages. Runs only once, later a
+        client without rooms has been unsubscribed from all of them.
+        """
+        if self.r.exists(self.scoped_key):
+            return
+        for token_id in self.r.hkeys(self.clients_key):
+            token_id = token_id.decode('utf-8')
+            if not self.r.exists(self.rooms_key.format(token_id=token_id)):
+                self.subscribe(token_id, [self.ALL_ROOMS])
+        self.r.set(self.scoped_key, 1)
 
     def get_name(self, token_id):
+        registry = self.registry()
+        if registry is not None:
+            return registry.names.get(token_id, None)
         n = self.r.hget(self.clients_name_key, token_id)
         return n.decode('utf-8') if isinstance(n, bytes) else None
 
     def revoke(self, token_id):
-        self.r.hdel(self.clients_key, args.token_id)
-        queue = self.queue_key.format(token_id=token_id)
-        self.r.delete(queue)
+        self.r.hdel(self.clients_key, token_id)
+        self.unsubscribe(token_id, self.get_rooms(token_id))
+        self.r.delete(self.rooms_key.format(token_id=token_id))
+        cursors = list(self.r.scan_iter(
+            match=self.cursor_key.format(token_id=token_id, room="*")))
+        if cursors:
+            self.r.delete(*cursors)
+        self._notify()
 
     def exists(self, token_id):
-        return self.r.hexists(self.clients_key, args.token_id)
+        return self.r.hexists(self.clients_key, token_id)
+
+
+class TestAPIClientManager(unittest.TestCase):
+
+    def test_cached_registry(self):
+        try:
+            import fakeredis
+        except ImportError:
+            self.skipTest("fakeredis is not installed")
+        from .models import Message
+
+        server = fakeredis.FakeServer()
+        admin = APIClientManager(fakeredis.FakeStrictRedis(server=server))
+        admin.add("1", "key", "bot", rooms=["test"])
+        mgr = APIClientManager(
+            fakeredis.FakeStrictRedis(server=server), cached=True)
+        self.assertTrue(mgr.auth("1", "key"))
+        self.assertFalse(mgr.auth("1", "wrong"))
+        self.assertEqual(mgr.get_name("1"), "bot")
+
+        p = mgr.r.pipeline(transaction=False)
+        mgr.publish(Message("irc", "a", "#test", "hi", room="test"), pipe=p)
+        mgr.publish(Message("irc", "a", "#other", "hi", room="other"), pipe=p)
+        self.assertEqual(len(p.command_stack), 1)
+        p.reset()
+
+        # uncached, the script is queued as a single command
+        admin.publish(Message("irc", "a", "#test", "hi", room="test"), pipe=p)
+        self.assertEqual(len(p.command_stack), 1)
+        self.assertEqual(p.command_stack[0][0][0], "EVAL")
+        p.execute()
+        self.assertEqual(p.scripts, set())
+        self.assertEqual(mgr.r.xlen(mgr.log_key.format(room="test")), 1)
+
+        # changes made by another manager reach the cache
+        admin.revoke("1")
+        for _ in range(50):
+            if mgr.registry(load=False) is None:
+                break
+            time.sleep(0.1)
+        self.assertFalse(mgr.auth("1", "key"))
+        self.assertFalse(mgr.is_subscribed("1", "test"))
+
+    def test_subscribe_unscoped(self):
+        try:
+            import fakeredis
+        except ImportError:
+            self.skipTest("fakeredis is not installed")
+
+        mgr = APIClientManager(fakeredis.FakeStrictRedis())
+        # added before room subscriptions existed
+        mgr.r.hset(mgr.clients_key, "1", b"")
+        mgr.add("2", "key", "bot", rooms=["test"])
+        mgr.subscribe_unscoped()
+        self.assertEqual(mgr.get_rooms("1"), [mgr.ALL_ROOMS])
+        self.assertEqual(mgr.get_rooms("2"), ["test"])
+
+        # unsubscribed from its last room, it stays so on the next start
+        mgr.unsubscribe("2", ["test"])
+        mgr.subscribe_unscoped()
+        self.assertEqual(mgr.get_rooms("2"), [])
+        self.assertFalse(mgr.is_subscribed("2", "test"))
 
 
 if __name__ == "__main__":
@@ -90,12 +397,24 @@ if __name__ == "__main__":
     subparsers.add_parser('list', aliases=['l'], help="list tokens")
     sp = subparsers.add_parser('add', aliases=['a'], help="add a token")
     sp.add_argument('-n', '--name', required=True, help='bot name')
+    sp.add_argument('-r', '--room', action='append', dest='rooms',
+                    help='subscribed room, may be repeated (default all rooms)')
     sp.add_argument('token_id', nargs='?', default='',
                     help='token id (auto generate if unspecified)')
     sp.add_argument('token_key', nargs='?', default='',
                     help='token key (auto generate if unspecified)')
     sp = subparsers.add_parser('revoke', aliases=['r'], help="revoke a token")
     sp.add_argument('token_id', help='token_id')
+    sp = subparsers.add_parser(
+        'subscribe', aliases=['s'], help="subscribe a token to rooms")
+    sp.add_argument('token_id', help='token id')
+    sp.add_argument('rooms', nargs='+',
+                    help='room names, {} for all rooms'.format(
+                        APIClientManager.ALL_ROOMS))
+    sp = subparsers.add_parser(
+        'unsubscribe', aliases=['u'], help="unsubscribe a token from rooms")
+    sp.add_argument('token_id', help='token id')
+    sp.add_argument('rooms', nargs='+', help='room names')
     sp = subparsers.add_parser('test', help="test authenticating a token")
     sp.add_argument('token_id', help='token id')
     sp.add_argument('token_key', help='token key')
@@ -111,8 +430,10 @@ if __name__ == "__main__":
     mgr = APIClientManager(r)
 
     if args.command in ("list", "l"):
-        print("\n".join(["{}: {}".format(_id, n)
-                         for _id, n in mgr.list_clients()]))
+        print("\n".join([
+            "{}: {} [{}]".format(_id, n, " ".join(mgr.get_rooms(_id)))
+            for _id, n in mgr.list_clients()
+        ]))
 
     elif args.command in ("add", "a"):
         if args.token_id and args.token_key:
@@ -125,7 +446,8 @@ if __name__ == "__main__":
             print('Please specify both or neither of token_id and token_key')
             sys.exit(-1)
         try:
-            mgr.add(token_id, token_key, args.name)
+            mgr.add(token_id, token_key, args.name,
+                    args.rooms or [mgr.ALL_ROOMS])
         except TokenException as e:
             print(e)
         else:
@@ -138,6 +460,17 @@ if __name__ == "__main__":
         else:
             print("Cancelled")
 
+    elif args.command in ("subscribe", "s", "unsubscribe", "u"):
+        if not mgr.exists(args.token_id):
+            print("No such token: {}".format(args.token_id))
+            sys.exit(-1)
+        if args.command in ("subscribe", "s"):
+            mgr.subscribe(args.token_id, args.rooms)
+        else:
+            mgr.unsubscribe(args.token_id, args.rooms)
+        print("{}: {}".format(
+            args.token_id, " ".join(mgr.get_rooms(args.token_id))))
+
     elif args.command == "test":
         print(mgr.auth(args.token_id, args.token_key))
 
@@ -1,17 +1,89 @@
 #!/usr/bin/env python3
 import re
+import threading
+import unittest
 from typing import Tuple
-from .models import Message, MessageType, Color
+from collections import namedtuple
+from .models import Message, MessageType, ChannelType, Color
 from .helpers import download_file
 from .command import LEADING_CHARS, parse_command
 
 
+BridgeCapability = namedtuple(
+    'BridgeCapability',
+    ('multiline', 'photo')
+)
+
+# Capabilities of each bot by ChanTag, so that the core knows what a route
+# needs without importing the bots. Bots take their SupportMultiline and
+# SupportPhoto from here, unless the class body sets them.
+bridge_capabilities = {
+    ChannelType.IRC: BridgeCapability(multiline=False, photo=False),
+    ChannelType.XMPP: BridgeCapability(multiline=False, photo=False),
+    ChannelType.Telegram: BridgeCapability(multiline=True, photo=True),
+    ChannelType.Gitter: BridgeCapability(multiline=True, photo=False),
+    ChannelType.Matrix: BridgeCapability(multiline=True, photo=False),
+    ChannelType.Wechat: BridgeCapability(multiline=True, photo=True),
+}
+
+
+class SendError(Exception):
+    """\
+    A send failed in a way worth retrying later, e.g. a timeout or a server
+    error of the IM.
+
+    Attributes:
+        line: index of the first line not sent, when a message is sent
+            line by line
+    """
+
+    def __init__(self, *args, line=0):
+        super(SendError, self).__init__(*args)
+        self.line = line
+
+
+def must_send(im: str, post, *args, **kwargs):
+    """\
+    Send with post(*args, **kwargs), an HTTP request returning a response,
+    or None on errors like timeouts, and raise SendError on failures worth
+    retrying: no response, rate limiting or a server error of the IM
+
+    Args:
+        im: name of the IM in errors, e.g. "Telegram"
+    """
+    r = post(*args, **kwargs)
+    if r is None:
+        raise SendError("Error requesting {}".format(im))
+    if r.status_code == 429 or r.status_code >= 500:
+        raise SendError(
+            "{} returned {}: {}".format(im, r.status_code, r.text[:200]))
+    return r
+
+
+def is_line_oriented(chantag: str) -> bool:
+    """\
+    Whether a bot sends long text line by line (or as a text_url)
+    """
+    cap = bridge_capabilities.get(chantag, None)
+    return cap is None or not cap.multiline
+
+
 class BaseBotInstance(object):
 
     ChanTag = None
     SupportMultiline = False
     SupportPhoto = False
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cap = bridge_capabilities.get(cls.ChanTag, None)
+        if cap is None:
+            return
+        if 'SupportMultiline' not in cls.__dict__:
+            cls.SupportMultiline = cap.multiline
+        if 'SupportPhoto' not in cls.__dict__:
+            cls.SupportPhoto = cap.photo
+
     def send_msg(self, target: str, content: str, sender=None, **kwargs):
         pass
 
@@ -43,7 +115,11 @@ class BaseBotInstance(object):
         )
         return (m.group('nick'), m.group('content')) if m else (None, None)
 
-    def forward_msg_from_fishroom(self, msg: Message):
+    def forward_msg_from_fishroom(self, msg: Message, start_line=0):
+        """\
+        Send msg to its target of this bot, from line start_line on when
+        sending line by line. Raises SendError on failures worth retrying.
+        """
         if self.ChanTag == msg.channel and (not msg.botmsg):
             return
 
@@ -82,16 +158,140 @@ class BaseBotInstance(object):
         else:
             lines = msg.lines
 
-        for i, line in enumerate(lines):
+        for i, line in enumerate(lines[start_line:], start_line):
             sender = None if msg.botmsg else msg.sender
-            self.send_msg(
-                target, content=line, sender=sender, rich_text=msg.rich_text,
-                first=(i == 0), raw=msg, **msg.opt,
-            )
+            try:
+                self.send_msg(
+                    target, content=line, sender=sender,
+                    rich_text=msg.rich_text, first=(i == 0), raw=msg,
+                    **msg.opt,
+                )
+            except SendError as e:
+                e.line = i
+                raise
+
+    def forward_msgs_from_bus(self, bus, forward=None):
+        """\
+        Read messages from bus in a background thread into a bounded
+        outbound queue, and send them on per-target lanes. Failed sends
+        are retried later by the RetrySchedule of this bot.
+
+        On a StreamMessageBus, a message is acked once it is sent or
+        scheduled for a retry (or summarized by StaleDigest), and the
+        outbound queue holds the bus reader back instead of dropping, so
+        that messages not handled yet are replayed after a crash.
+
+        Retries go through the lane of their target like other messages,
+        so they do not interleave with them, but a retried message arrives
+        after those sent since it failed.
+
+        Args:
+            bus: fish2im message bus of this bot
+            forward: function sending one message, called as
+                forward(msg, start_line), defaults to
+                self.forward_msg_from_fishroom
+        """
+        from .egress import (
+            get_outbound_queue, egress_options, StaleDigest, TargetLanes)
+        from .retry import get_retry_schedule
+        from .bus import StreamMessageBus
+        forward = forward or self.forward_msg_from_fishroom
+        options = egress_options(self.ChanTag)
+        durable = isinstance(bus, StreamMessageBus)
+        if durable:
+            bus.manual_ack = True
+        outbound = get_outbound_queue(self.ChanTag, block=durable)
+        stale = StaleDigest(
+            options.get("max_age", None), outbound.metrics,
+            quiet=options.get("digest_quiet", 5),
+        )
+        retries = get_retry_schedule(self.ChanTag)
+
+        def send(msg, start_line=0, attempts=0):
+            try:
+                forward(msg, start_line)
+            except SendError as e:
+                retries.schedule(
+                    msg, line=e.line, error=str(e), attempts=attempts)
+            msg.ack()
+
+        coalesce_ms = options.get("coalesce_ms", None)
+        lanes = TargetLanes(
+            send, options.get("workers", 4), metrics=outbound.metrics,
+            window=(
+                coalesce_ms / 1000
+                if coalesce_ms and not self.SupportMultiline else None
+            ),
+            max_bytes=options.get("coalesce_bytes", 400),
+        )
+        tag = self.ChanTag.lower()
+
+        def target_of(msg):
+            return (msg.route or {}).get(tag, None)
+
+        retries.start(
+            lambda msg, line, attempts:
+            lanes.submit(target_of(msg), msg, line, attempts)
+        )
+        threading.Thread(
+            target=outbound.consume, args=(bus.message_stream(), ),
+            daemon=True,
+        ).start()
+        while True:
+            msg = outbound.get(timeout=stale.wait_time())
+            msgs = stale.filter(msg) if msg is not None else []
+            for m in msgs + stale.flush():
+                lanes.submit(target_of(m), m)
 
 
 class EmptyBot(BaseBotInstance):
     ChanTag = "__NULL__"
 
 
+class TestMustSend(unittest.TestCase):
+
+    def test_must_send(self):
+        Response = namedtuple('Response', ('status_code', 'text'))
+        for resp, retry in ((None, True), (Response(429, ""), True),
+                            (Response(502, ""), True),
+                            (Response(400, ""), False)):
+            if retry:
+                with self.assertRaises(SendError):
+                    must_send("IM", lambda api: resp, "url")
+            else:
+                self.assertIs(must_send("IM", lambda api: resp, "url"), resp)
+
+
+class TestBridgeCapabilities(unittest.TestCase):
+
+    def test_bots_agree_with_table(self):
+        from importlib import import_module
+        bots = []
+        for name in ("IRC", "xmpp", "telegram", "gitter", "matrix", "wechat"):
+            try:
+                module = import_module("." + name, __package__)
+            except ImportError:
+                continue
+            bots += [
+                v for v in vars(module).values()
+                if isinstance(v, type) and issubclass(v, BaseBotInstance) and
+                v.ChanTag in bridge_capabilities
+            ]
+        bots.append(type("Bot", (BaseBotInstance, ), {
+            "ChanTag": ChannelType.Telegram}))
+        for bot in bots:
+            cap = bridge_capabilities[bot.ChanTag]
+            self.assertEqual(
+                (bot.SupportMultiline, bot.SupportPhoto),
+                (cap.multiline, cap.photo), bot.__name__)
+            self.assertEqual(
+                is_line_oriented(bot.ChanTag), not bot.SupportMultiline)
+
+    def test_opt_out(self):
+        bot = type("Bot", (BaseBotInstance, ), {
+            "ChanTag": ChannelType.Telegram, "SupportPhoto": False})
+        self.assertEqual((bot.SupportMultiline, bot.SupportPhoto),
+                         (True, False))
+
+
 # vim: ts=4 sw=4 sts=4 expandtab
@@ -1,9 +1,30 @@
 #!/usr/bin/env python
+import os
+import copy
+import functools
+import json
+import time
+import zlib
+import queue
+import struct
+import socket
 import typing
+import unittest
+import threading
+import socketserver
 from enum import Enum
 
-from .models import Message
+import redis
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from .models import Message, MessagePriority
 from .config import config
+from .helpers import get_logger
+
+logger = get_logger("Bus")
 
 
 class MsgDirection(Enum):
@@ -11,30 +32,746 @@ class MsgDirection(Enum):
     fish2im = 2
 
 
+class WireCodec(object):
+    """\
+    Encoding of messages on the bus. Every payload starts with one format
+    byte, so that different encodings can coexist during a rolling upgrade:
+    consumers decode anything, producers pick the format from config.
+    Plain JSON, as sent by older versions, is recognized by its leading "{".
+
+    Attributes:
+        fmt: "json" or "msgpack"
+        compress_threshold: payloads of at least this many bytes are
+            compressed with zlib, None to never compress
+    """
+
+    JSON = 0x7b  # b"{", plain JSON carries no extra header byte
+    MSGPACK = 0x01
+    ZLIB_JSON = 0x02
+    ZLIB_MSGPACK = 0x03
+
+    def __init__(self, fmt="json", compress_threshold=None):
+        if fmt not in ("json", "msgpack"):
+            raise Exception("Unknown wire format: {}".format(fmt))
+        if fmt == "msgpack" and msgpack is None:
+            raise Exception("msgpack is not installed")
+        self.fmt = fmt
+        self.compress_threshold = compress_threshold
+
+    def encode(self, msg: Message) -> bytes:
+        # the same bytes are reused for every channel a message goes to
+        return msg.cached(
+            ("wire", self.fmt, self.compress_threshold),
+            lambda: self._encode(msg),
+        )
+
+    def _encode(self, msg: Message) -> bytes:
+        if self.fmt == "msgpack":
+            header, zheader = self.MSGPACK, self.ZLIB_MSGPACK
+            data = msgpack.packb(msg.dump(), use_bin_type=True)
+        else:
+            header, zheader = None, self.ZLIB_JSON
+            data = msg.dumps().encode('utf-8')
+
+        if self.compress_threshold is not None and \
+                len(data) >= self.compress_threshold:
+            return bytes((zheader, )) + zlib.compress(data)
+        if header is None:
+            return data
+        return bytes((header, )) + data
+
+    def decode(self, data: bytes) -> Message:
+        try:
+            header = data[0]
+            if header == self.JSON:
+                return Message.load(json.loads(data))
+
+            payload = memoryview(data)[1:]
+            if header == self.MSGPACK:
+                return Message.load(msgpack.unpackb(payload, raw=False))
+            elif header == self.ZLIB_JSON:
+                return Message.load(json.loads(zlib.decompress(payload)))
+            elif header == self.ZLIB_MSGPACK:
+                return Message.load(
+                    msgpack.unpackb(zlib.decompress(payload), raw=False))
+        except:
+            pass
+        return Message("fishroom", "fishroom", "None", "Error")
+
+
 class MessageBus(object):
+    """\
+    Message bus on redis pub/sub, messages published while a subscriber is
+    away are lost.
+
+    A bus with a name subscribes to its own sub-channel, e.g. on fish2im
+    each bridge has "fishroom:fish_msg_channel:irc", and a message is
+    published only to the channels of bridges in its route. On im2fish, the
+    unnamed core reads the main channel, router shards read their own.
+
+    Attributes:
+        r: redis client
+        d: message direction
+        name: subscriber name, e.g. the ChanTag of a bridge
+        codec: wire codec of messages
+    """
 
     CHANNELS = {
         MsgDirection.im2fish: config["redis"]["prefix"] + ":" + "im_msg_channel",
         MsgDirection.fish2im: config["redis"]["prefix"] + ":" + "fish_msg_channel",
     }
 
-    def __init__(self, redis_client, direction: MsgDirection):
+    def __init__(self, redis_client, direction: MsgDirection, name=None,
+                 codec: WireCodec=None):
         self.r = redis_client
         self.d = direction
+        self.name = name
+        self.codec = codec or WireCodec()
+
+    def channel_of(self, target=None) -> str:
+        chan = self.CHANNELS[self.d]
+        return chan if target is None else chan + ":" + target
 
     @property
     def channel(self) -> str:
-        return self.CHANNELS[self.d]
+        return self.channel_of(self.name)
+
+    def channel_for(self, target, msg: Message) -> str:
+        """\
+        Channel msg is published to for target
+        """
+        return self.channel_of(target)
+
+    def targets(self, msg: Message) -> list:
+        """\
+        Sub-channels a message should be published to
+        """
+        if self.d == MsgDirection.im2fish:
+            return [None]
+        # bindings may carry non-IM options like "web_post"
+        return [
+            tag for tag, target in (msg.route or {}).items()
+            if isinstance(target, str) and (msg.botmsg or tag != msg.channel)
+        ]
+
+    def _send(self, p, channel: str, data: bytes):
+        p.publish(channel, data)
 
-    def publish(self, msg: Message):
-        self.r.publish(self.channel, msg.dumps())
+    def publish(self, msg: Message, pipe=None, targets=None):
+        """\
+        Publish msg, queue the commands on pipe instead if it is given.
+        targets overrides the sub-channels given by self.targets(msg).
+        """
+        data = self.codec.encode(msg)
+        p = pipe if pipe is not None else self.r.pipeline(transaction=False)
+        if targets is None:
+            targets = self.targets(msg)
+        for target in targets:
+            self._send(p, self.channel_for(target, msg), data)
+        if pipe is None:
+            p.execute()
+
+    def has_subscriber(self, target) -> bool:
+        return self.r.pubsub_numsub(self.channel_of(target))[0][1] > 0
+
+    def wait_subscribed(self, target, timeout=30) -> bool:
+        """\
+        Block until messages published to target from now on reach its
+        subscriber, or for at most timeout seconds. Returns whether it does.
+        """
+        deadline = time.time() + timeout
+        while not self.has_subscriber(target):
+            if time.time() > deadline:
+                logger.warning("no subscriber of {} after {}s".format(
+                    self.channel_of(target), timeout))
+                return False
+            time.sleep(0.1)
+        return True
 
     def message_stream(self) -> typing.Iterator[Message]:
         p = self.r.pubsub()
         p.subscribe(self.channel)
         for rmsg in p.listen():
             if rmsg is not None and rmsg['type'] == "message":
-                yield Message.loads(rmsg['data'].decode('utf-8'))
+                yield self.codec.decode(rmsg['data'])
+
+
+class StreamMessageBus(MessageBus):
+    """\
+    Message bus on redis streams. Each subscriber is a consumer group whose
+    offset is kept by redis, so a restarting or stalled bridge picks up
+    where it left off. A message is acked only after the consumer has
+    handled it, entries left unacked by a crash are replayed on restart.
+    By default a message counts as handled once the consumer asks for the
+    next one, with manual_ack only once Message.ack() is called, for
+    consumers handing messages on to other threads.
+
+    With priorities, media and events go to streams of their own, e.g.
+    "fishroom:fish_msg_stream:irc:p1", read alongside the main stream and
+    handed out after text of the same read, so a backlog of stickers does
+    not hold up text.
+
+    Attributes:
+        maxlen: approximate max length of the stream
+        block: milliseconds to block on each read, 0 for forever
+        priorities: whether to split streams by Message.priority
+        manual_ack: whether messages are acked by Message.ack()
+    """
+
+    STREAMS = {
+        MsgDirection.im2fish: config["redis"]["prefix"] + ":" + "im_msg_stream",
+        MsgDirection.fish2im: config["redis"]["prefix"] + ":" + "fish_msg_stream",
+    }
+
+    def __init__(self, redis_client, direction: MsgDirection, name=None,
+                 codec: WireCodec=None, maxlen=10000, block=0, batch=32,
+                 priorities=False):
+        super(StreamMessageBus, self).__init__(
+            redis_client, direction, name, codec)
+        self.maxlen = maxlen
+        self.block = block
+        self.batch = batch
+        self.priorities = priorities
+        self.manual_ack = False
+
+    def channel_of(self, target=None) -> str:
+        stream = self.STREAMS[self.d]
+        return stream if target is None else stream + ":" + target
+
+    def channel_for(self, target, msg: Message) -> str:
+        stream = self.channel_of(target)
+        if not self.priorities or msg.priority == MessagePriority.High:
+            return stream
+        return "{}:p{}".format(stream, msg.priority)
+
+    @property
+    def streams(self) -> list:
+        """\
+        Streams read by this consumer, most urgent first
+        """
+        if not self.priorities:
+            return [self.channel]
+        return [self.channel] + [
+            "{}:p{}".format(self.channel, level)
+            for level in MessagePriority.levels
+            if level != MessagePriority.High
+        ]
+
+    @property
+    def group(self) -> str:
+        return self.name or "core"
+
+    def _send(self, p, channel: str, data: bytes):
+        p.xadd(channel, {"msg": data}, maxlen=self.maxlen, approximate=True)
+
+    def wait_subscribed(self, target, timeout=30) -> bool:
+        # a consumer group keeps messages until its consumer comes
+        StreamMessageBus(
+            self.r, self.d, target, self.codec, priorities=self.priorities,
+        ).ensure_group()
+        return True
+
+    def ensure_group(self):
+        for stream in self.streams:
+            try:
+                # a new group only sees messages published after its creation
+                self.r.xgroup_create(
+                    stream, self.group, id="$", mkstream=True)
+            except redis.exceptions.ResponseError as e:
+                if "BUSYGROUP" not in str(e):
+                    raise
+
+    def message_stream(self) -> typing.Iterator[Message]:
+        self.ensure_group()
+        # "0" reads our own pending (delivered but unacked) entries,
+        # ">" reads entries never delivered to this group
+        last_ids = {stream: "0" for stream in self.streams}
+        while True:
+            replaying = any(i != ">" for i in last_ids.values())
+            ret = self.r.xreadgroup(
+                self.group, self.group, last_ids, count=self.batch,
+                block=(None if replaying else self.block),
+            )
+            got = {
+                (s.decode('utf-8') if isinstance(s, bytes) else s): entries
+                for s, entries in (ret or [])
+            }
+
+            for stream in self.streams:
+                entries = got.get(stream, None)
+                if not entries:
+                    if last_ids[stream] != ">":
+                        last_ids[stream] = ">"
+                    continue
+
+                for entry_id, fields in entries:
+                    if last_ids[stream] != ">":
+                        last_ids[stream] = entry_id
+                    # fields of pending entries trimmed by MAXLEN are gone
+                    if not fields:
+                        self.r.xack(stream, self.group, entry_id)
+                        continue
+                    msg = self.codec.decode(fields[b'msg'])
+                    if self.manual_ack:
+                        msg.on_ack(functools.partial(
+                            self.r.xack, stream, self.group, entry_id))
+                        yield msg
+                    else:
+                        yield msg
+                        self.r.xack(stream, self.group, entry_id)
+
+
+class LocalMessageBus(MessageBus):
+    """\
+    Message bus on in-memory queues, for the core and bridges running in one
+    process. Messages are passed as objects without serialization, each
+    subscriber gets its own shallow copy.
+
+    The queue of a channel is created along with the first bus reading it,
+    so messages published before the subscriber calls message_stream, e.g.
+    while the threads of allinone are starting, wait for it. Messages to a
+    channel without a bus reading it are dropped. A queue holding maxlen
+    messages drops new ones, so that a stalled subscriber does not grow it
+    without bound.
+
+    Attributes:
+        maxlen: max number of messages waiting in a queue
+    """
+
+    _queues = {}
+    _lock = threading.Lock()
+
+    def __init__(self, redis_client, direction: MsgDirection, name=None,
+                 codec: WireCodec=None, maxlen=10000):
+        super(LocalMessageBus, self).__init__(
+            redis_client, direction, name, codec)
+        self.maxlen = maxlen
+        with self._lock:
+            self._queue = self._queues.setdefault(
+                self.channel, queue.Queue(maxlen))
+
+    def _send(self, p, channel: str, msg: Message):
+        q = self._queues.get(channel, None)
+        if q is None:
+            return
+        try:
+            q.put_nowait(copy.copy(msg))
+        except queue.Full:
+            logger.warning("{} is full, message dropped".format(channel))
+
+    def publish(self, msg: Message, pipe=None, targets=None):
+        if targets is None:
+            targets = self.targets(msg)
+        for target in targets:
+            self._send(None, self.channel_for(target, msg), msg)
+
+    def has_subscriber(self, target) -> bool:
+        return self.channel_of(target) in self._queues
+
+    def message_stream(self) -> typing.Iterator[Message]:
+        while True:
+            yield self._queue.get()
+
+
+# a frame is: body length, op, channel length, channel, payload
+FRAME_HEADER = struct.Struct("!IcH")
+OP_SUB, OP_PUB, OP_MSG = b"S", b"P", b"M"
+
+
+def pack_frame(op: bytes, channel: str, payload: bytes=b"") -> bytes:
+    chan = channel.encode('utf-8')
+    return FRAME_HEADER.pack(3 + len(chan) + len(payload), op, len(chan)) + \
+        chan + payload
+
+
+def send_frame(sock: socket.socket, op: bytes, channel: str,
+               payload: bytes=b""):
+    sock.sendall(pack_frame(op, channel, payload))
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            raise ConnectionError("bus connection closed")
+        buf += chunk
+    return bytes(buf)
+
+
+def recv_frame(sock: socket.socket) -> typing.Tuple[bytes, str, bytes]:
+    size, op, chan_len = FRAME_HEADER.unpack(
+        _recv_exactly(sock, FRAME_HEADER.size))
+    body = _recv_exactly(sock, size - 3)
+    return op, body[:chan_len].decode('utf-8'), body[chan_len:]
+
+
+class SubscriberWriter(object):
+    """\
+    Send queue of a connection subscribed to the broker, written to the
+    socket by a thread of its own, so that a stalled subscriber does not
+    hold up publishers and the other subscribers.
+
+    Attributes:
+        conn: socket of the subscriber
+        maxlen: max number of frames waiting to be sent
+    """
+
+    def __init__(self, conn: socket.socket, maxlen=10000):
+        self.conn = conn
+        self.frames = queue.Queue(maxlen)
+        threading.Thread(target=self._write, daemon=True).start()
+
+    def put(self, frame: bytes) -> bool:
+        """\
+        Queue frame, False if the queue is full
+        """
+        try:
+            self.frames.put_nowait(frame)
+        except queue.Full:
+            return False
+        return True
+
+    def _write(self):
+        for frame in iter(self.frames.get, None):
+            try:
+                self.conn.sendall(frame)
+            except OSError:
+                # the handler of the connection unsubscribes it
+                self.close()
+                return
+
+    def close(self):
+        try:
+            self.frames.put_nowait(None)
+        except queue.Full:
+            pass
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class BusBroker(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """\
+    Broker of SocketMessageBus, relays frames published to a channel to every
+    connection subscribed to it. Runs in the core process.
+
+    Each subscriber has a SubscriberWriter, one falling maxlen frames behind
+    is disconnected, like redis does with slow pub/sub clients, and gets
+    messages again once it reconnects.
+
+    Attributes:
+        path: path of the socket
+        maxlen: max number of frames waiting for a subscriber
+    """
+
+    daemon_threads = True
+    running = {}  # path -> broker serving in this process
+
+    def __init__(self, path, maxlen=10000):
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except OSError:
+                # left by a broker that is gone
+                os.unlink(path)
+            else:
+                raise Exception(
+                    "A bus broker is already running on {}".format(path))
+            finally:
+                probe.close()
+        self.maxlen = maxlen
+        self.subscribers = {}  # channel -> set of conns
+        self.writers = {}  # conn -> SubscriberWriter
+        self.lock = threading.Lock()
+        super(BusBroker, self).__init__(path, BusBrokerHandler)
+        self.running[path] = self
+
+    def server_close(self):
+        super(BusBroker, self).server_close()
+        self.running.pop(self.server_address, None)
+
+    def relay(self, channel: str, payload: bytes):
+        frame = pack_frame(OP_MSG, channel, payload)
+        with self.lock:
+            writers = [
+                self.writers[conn]
+                for conn in self.subscribers.get(channel, ())
+            ]
+        for writer in writers:
+            if not writer.put(frame):
+                logger.warning(
+                    "subscriber of {} is too slow, disconnected".format(
+                        channel))
+                self.unsubscribe(writer.conn)
+
+    def subscribe(self, conn, channel: str):
+        with self.lock:
+            if conn not in self.writers:
+                self.writers[conn] = SubscriberWriter(conn, self.maxlen)
+            self.subscribers.setdefault(channel, set()).add(conn)
+
+    def unsubscribe(self, conn):
+        with self.lock:
+            for conns in self.subscribers.values():
+                conns.discard(conn)
+            writer = self.writers.pop(conn, None)
+        if writer is not None:
+            writer.close()
+
+    def serve_in_thread(self):
+        t = threading.Thread(target=self.serve_forever, daemon=True)
+        t.start()
+        return t
+
+
+class BusBrokerHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        try:
+            while True:
+                op, channel, payload = recv_frame(self.request)
+                if op == OP_PUB:
+                    self.server.relay(channel, payload)
+                elif op == OP_SUB:
+                    self.server.subscribe(self.request, channel)
+        except (OSError, struct.error):
+            pass
+        finally:
+            self.server.unsubscribe(self.request)
+
+
+class SocketMessageBus(MessageBus):
+    """\
+    Message bus over a unix domain socket to the broker in the core process,
+    for bridges on the same host. Same semantics as pub/sub: messages
+    published while a subscriber is disconnected are lost.
+
+    Attributes:
+        path: path of the broker socket
+    """
+
+    def __init__(self, redis_client, direction: MsgDirection, name=None,
+                 codec: WireCodec=None, path=None):
+        super(SocketMessageBus, self).__init__(
+            redis_client, direction, name, codec)
+        self.path = path
+        self._sock = None
+        self._lock = threading.Lock()
+
+    def has_subscriber(self, target) -> bool:
+        broker = BusBroker.running.get(self.path, None)
+        if broker is None:
+            # the broker is in another process, nothing to tell
+            return True
+        with broker.lock:
+            return bool(broker.subscribers.get(self.channel_of(target)))
+
+    def _connect(self) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def publish(self, msg: Message, pipe=None, targets=None):
+        data = self.codec.encode(msg)
+        if targets is None:
+            targets = self.targets(msg)
+        with self._lock:
+            # reconnect once, the broker may have restarted with the core
+            for retry in (False, True):
+                try:
+                    if self._sock is None:
+                        self._sock = self._connect()
+                    for target in targets:
+                        send_frame(
+                            self._sock, OP_PUB, self.channel_for(target, msg),
+                            data)
+                    return
+                except OSError:
+                    if self._sock is not None:
+                        self._sock.close()
+                        self._sock = None
+                    if retry:
+                        logger.exception("failed to publish to bus")
+
+    def message_stream(self) -> typing.Iterator[Message]:
+        while True:
+            try:
+                sock = self._connect()
+            except OSError:
+                logger.warning("bus broker {} unavailable".format(self.path))
+                time.sleep(1)
+                continue
+            try:
+                send_frame(sock, OP_SUB, self.channel)
+                while True:
+                    op, channel, payload = recv_frame(sock)
+                    if op == OP_MSG:
+                        yield self.codec.decode(payload)
+            except (OSError, struct.error):
+                logger.warning("lost connection to bus broker, reconnecting")
+            finally:
+                sock.close()
+
+
+def get_message_bus(redis_client, direction: MsgDirection, name=None) -> MessageBus:
+    """\
+    Create a message bus with the backend set in config["bus"]
+
+    Args:
+        redis_client: redis client
+        direction: message direction
+        name: subscriber name, used as consumer group on the stream backend
+    """
+    options = config.get("bus", {})
+    backend = options.get("backend", "pubsub")
+    codec = WireCodec(
+        options.get("codec", "json"), options.get("compress_threshold", None))
+    if backend == "stream":
+        return StreamMessageBus(
+            redis_client, direction, name, codec,
+            maxlen=options.get("maxlen", 10000),
+            priorities=options.get("priorities", False),
+        )
+    elif backend == "local":
+        return LocalMessageBus(
+            redis_client, direction, name,
+            maxlen=options.get("maxlen", 10000),
+        )
+    elif backend == "unix":
+        return SocketMessageBus(
+            redis_client, direction, name, codec,
+            path=options.get("path", "/tmp/fishroom-bus.sock"),
+        )
+    return MessageBus(redis_client, direction, name, codec)
+
+
+def get_bus_broker() -> BusBroker:
+    """\
+    Create the broker of the "unix" backend, None for other backends
+    """
+    options = config.get("bus", {})
+    if options.get("backend", "pubsub") != "unix":
+        return None
+    return BusBroker(
+        options.get("path", "/tmp/fishroom-bus.sock"),
+        maxlen=options.get("maxlen", 10000),
+    )
+
+
+class TestWireCodec(unittest.TestCase):
+
+    def test_roundtrip(self):
+        m = Message("irc", "tester", "#test", "x" * 2048, room="test")
+        codecs = [WireCodec(), WireCodec(compress_threshold=1024)]
+        if msgpack is not None:
+            codecs += [WireCodec("msgpack"),
+                       WireCodec("msgpack", compress_threshold=1024)]
+        for c in codecs:
+            self.assertEqual(c.decode(c.encode(m)).dump(), m.dump())
+
+    def test_plain_json(self):
+        m = Message("irc", "tester", "#test", "hello")
+        data = WireCodec().encode(m)
+        self.assertEqual(data, m.dumps().encode('utf-8'))
+        self.assertEqual(
+            WireCodec(compress_threshold=1).decode(data).content, "hello")
+        self.assertEqual(WireCodec().decode(b"\xff").content, "Error")
+
+
+class TestStreamMessageBus(unittest.TestCase):
+
+    def test_manual_ack(self):
+        try:
+            import fakeredis
+        except ImportError:
+            self.skipTest("fakeredis is not installed")
+        r = fakeredis.FakeStrictRedis()
+        sub = StreamMessageBus(r, MsgDirection.fish2im, "irc")
+        sub.manual_ack = True
+        sub.ensure_group()
+        StreamMessageBus(r, MsgDirection.fish2im).publish(
+            Message("telegram", "a", "-1", "hello", route={"irc": "#test"}))
+        stream = sub.message_stream()
+        m = next(stream)
+        self.assertEqual(r.xpending(sub.channel, sub.group)["pending"], 1)
+        m.ack()
+        self.assertEqual(r.xpending(sub.channel, sub.group)["pending"], 0)
+
+
+class TestLocalMessageBus(unittest.TestCase):
+
+    def test_copies_and_bound(self):
+        subs = [
+            LocalMessageBus(None, MsgDirection.fish2im, tag, maxlen=1)
+            for tag in ("test-irc", "test-telegram")
+        ]
+        pub = LocalMessageBus(None, MsgDirection.fish2im)
+        m = Message("xmpp", "a", "b", "hello", botmsg=True,
+                    route={"test-irc": "#test", "test-telegram": "-1"})
+        m.dumps()
+        pub.publish(m)
+        pub.publish(Message("xmpp", "a", "b", "dropped", botmsg=True,
+                            route={"test-irc": "#test"}))
+        # published before the subscribers start reading
+        irc, telegram = [next(sub.message_stream()) for sub in subs]
+        self.assertIsNot(irc, telegram)
+        self.assertNotIn('_cache', irc.__dict__)
+        irc.content = "changed"
+        self.assertIn('"hello"', telegram.dumps())
+        self.assertTrue(subs[0]._queue.empty())
+
+
+class TestSocketMessageBus(unittest.TestCase):
+
+    def test_pub_sub(self):
+        import tempfile
+        path = os.path.join(tempfile.mkdtemp(), "bus.sock")
+        broker = BusBroker(path)
+        broker.serve_in_thread()
+        sub = SocketMessageBus(None, MsgDirection.fish2im, "irc", path=path)
+        pub = SocketMessageBus(None, MsgDirection.fish2im, path=path)
+        stream = sub.message_stream()
+        m = Message("telegram", "tester", "-1", "hello",
+                    route={"irc": "#test", "telegram": "-1"})
+
+        got = queue.Queue()
+        threading.Thread(
+            target=lambda: got.put(next(stream)), daemon=True).start()
+        while not broker.subscribers.get(sub.channel):
+            time.sleep(0.01)
+        pub.publish(m)
+        self.assertEqual(got.get(timeout=5).dump(), m.dump())
+        self.assertRaises(Exception, BusBroker, path)
+        broker.shutdown()
+        broker.server_close()
+
+    def test_slow_subscriber(self):
+        import tempfile
+        path = os.path.join(tempfile.mkdtemp(), "bus.sock")
+        broker = BusBroker(path, maxlen=2)
+        broker.serve_in_thread()
+        # subscribes and never reads
+        stalled = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stalled.connect(path)
+        send_frame(stalled, OP_SUB, "stalled")
+        while not broker.subscribers.get("stalled"):
+            time.sleep(0.01)
+
+        start = time.time()
+        for _ in range(20):
+            broker.relay("stalled", b"x" * 1024 * 1024)
+        self.assertLess(time.time() - start, 5)
+        self.assertFalse(broker.subscribers["stalled"])
+        stalled.close()
+        broker.shutdown()
+        broker.server_close()
 
 
 # vim: ts=4 sw=4 sts=4 expandtab
@@ -14,10 +14,19 @@ class ChatLogger(object):
     def __init__(self, redis_client):
         self.r = redis_client
 
-    def log(self, channel, msg: Message):
+    def log(self, channel, msg: Message, pipe=None):
+        """\
+        Log msg and return its index in today's log. If pipe is given, the
+        commands are queued on it instead, starting with the RPUSH whose
+        result minus 1 is the index.
+        """
         chan = self.CHANNEL.format(channel=channel)
-        self.r.publish(chan, msg.dumps())
-        return self.r.rpush(self.key(channel), msg.dumps()) - 1
+        data = msg.dumps()
+        p = pipe if pipe is not None else self.r.pipeline(transaction=False)
+        p.rpush(self.key(channel), data)
+        p.publish(chan, data)
+        if pipe is None:
+            return p.execute()[0] - 1
 
     def key(self, channel: str):
         return self.LOG_QUEUE_TMPL.format(
@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
 # -*- coding:utf-8 -*-
+import time
 import shlex
-from collections import namedtuple
+import threading
+import unittest
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
 from .config import config
 from .helpers import get_logger
 
@@ -9,9 +13,10 @@ logger = get_logger(__name__)
 
 LEADING_CHARS = ('/', '.')
 
+# inline handlers run on the routing thread, for those changing the message
 CmdHandler = namedtuple(
     'CmdHandler',
-    ('func', 'desc', 'usage')
+    ('func', 'desc', 'usage', 'inline')
 )
 CmdMe = config.get("cmd_me", "")
 
@@ -23,7 +28,8 @@ def register_command(cmd, func, **options):
         raise Exception("Command '%s' already registered" % cmd)
     logger.info("command `%s` registered" % cmd)
     command_handlers[cmd] = CmdHandler(
-        func, options.get("desc", ""), options.get("usage", ""))
+        func, options.get("desc", ""), options.get("usage", ""),
+        options.get("inline", False))
 
 
 def command(cmd, **options):
@@ -49,6 +55,82 @@ def get_command_handler(cmd):
     return command_handlers.get(cmd, None)
 
 
+class CommandExecutor(object):
+    """\
+    Run command handlers on a thread pool, so that slow commands do not hold
+    up routing. Commands of a room run one at a time in the order they were
+    submitted, as handlers like vote read and write state of the room,
+    while other rooms keep flowing.
+
+    Handlers get a `deadline` keyword argument (a timestamp) to give up by.
+    A command not started by its deadline is skipped. A handler is never
+    interrupted: one running past its deadline keeps running, holding up
+    later commands of its room, and only its reply is dropped. Slow
+    handlers should check the deadline themselves.
+
+    Attributes:
+        on_reply: called with (reply, msg, room) for each non-empty reply
+        timeout: seconds a command may take
+        slow: commands taking longer than this many seconds are logged
+    """
+
+    def __init__(self, on_reply, max_workers=4, timeout=10, slow=1):
+        self.on_reply = on_reply
+        self.timeout = timeout
+        self.slow = slow
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        # room -> deque of (handler, cmd, args, msg, submit time), present
+        # while a worker is draining it
+        self.lanes = {}
+        self.lock = threading.Lock()
+
+    def submit(self, handler: CmdHandler, cmd, args, msg, room):
+        with self.lock:
+            lane = self.lanes.get(room, None)
+            if lane is not None:
+                lane.append((handler, cmd, args, msg, time.time()))
+                return
+            self.lanes[room] = deque(
+                ((handler, cmd, args, msg, time.time()), ))
+        self.pool.submit(self._drain, room)
+
+    def _drain(self, room):
+        while True:
+            with self.lock:
+                lane = self.lanes[room]
+                if not lane:
+                    del self.lanes[room]
+                    return
+                handler, cmd, args, msg, submitted = lane.popleft()
+            self._run(handler, cmd, args, msg, room, submitted)
+
+    def _run(self, handler, cmd, args, msg, room, submitted):
+        deadline = submitted + self.timeout
+        start = time.time()
+        if start > deadline:
+            logger.warning(
+                "command `%s` skipped, not started in %ss", cmd, self.timeout)
+            return
+
+        try:
+            reply = handler.func(cmd, *args, msg=msg, room=room,
+                                 deadline=deadline)
+        except:
+            logger.exception("failed to execute command: {}".format(cmd))
+            return
+
+        now = time.time()
+        if now - start > self.slow:
+            logger.warning("command `%s` took %.3fs", cmd, now - start)
+        if now > deadline:
+            logger.warning(
+                "command `%s` timed out after %ss, reply dropped",
+                cmd, self.timeout)
+            return
+        if reply:
+            self.on_reply(reply, msg, room)
+
+
 @command("help", desc="list commands or usage", usage="help [cmd]")
 def list_commands(cmd, *args, **kwargs):
     if len(args) == 0:
@@ -64,6 +146,44 @@ def list_commands(cmd, *args, **kwargs):
         return "{}: {}\nUsage: {}".format(args[0], h.desc, h.usage)
 
 
+class TestCommandExecutor(unittest.TestCase):
+
+    def test_room_order(self):
+        replies = []
+        done = threading.Event()
+        started = threading.Event()
+
+        def slow(cmd, *args, **kwargs):
+            started.set()
+            time.sleep(0.1)
+            return cmd
+
+        def fast(cmd, *args, **kwargs):
+            if kwargs["room"] == "a":
+                done.set()
+            return cmd
+
+        ex = CommandExecutor(
+            lambda reply, msg, room: replies.append((room, reply)),
+            max_workers=2, timeout=0.05)
+        ex.submit(CmdHandler(slow, "", "", False), "new", [], None, "a")
+        started.wait(1)
+        ex.submit(CmdHandler(fast, "", "", False), "add", [], None, "a")
+        ex.submit(CmdHandler(fast, "", "", False), "other", [], None, "b")
+        ex.pool.shutdown(wait=True)
+        # "new" timed out, "add" was not started by its deadline
+        self.assertEqual(replies, [("b", "other")])
+        self.assertFalse(done.is_set())
+
+        ex = CommandExecutor(
+            lambda reply, msg, room: replies.append((room, reply)),
+            max_workers=2)
+        ex.submit(CmdHandler(slow, "", "", False), "new", [], None, "a")
+        ex.submit(CmdHandler(fast, "", "", False), "add", [], None, "a")
+        ex.pool.shutdown(wait=True)
+        self.assertEqual(replies[1:], [("a", "new"), ("a", "add")])
+
+
 if __name__ == "__main__":
 
     @command("test")
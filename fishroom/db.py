@@ -18,4 +18,38 @@ def get_redis():
     return __dbctx['redis']
 
 
+def reset():
+    """\
+    Forget the clients created so far, a forked process calls it to get
+    clients with connections of its own
+    """
+    __dbctx.clear()
+
+
+def get_async_redis():
+    """\
+    redis.asyncio client on a connection pool, for code running on an
+    asyncio event loop like the web server. The pool holds at most
+    config["redis"]["max_connections"] connections, beyond that a command,
+    e.g. of another API long poll, waits for one to be free.
+    """
+    if 'async_redis' not in __dbctx:
+        import redis.asyncio
+        options = {
+            "max_connections": config['redis'].get('max_connections', 64),
+            "timeout": 20,
+        }
+        if config['redis'].get('unix_socket_path') is not None:
+            pool = redis.asyncio.BlockingConnectionPool(
+                connection_class=redis.asyncio.UnixDomainSocketConnection,
+                path=config['redis']['unix_socket_path'], **options)
+        else:
+            pool = redis.asyncio.BlockingConnectionPool(
+                host=config['redis']['host'], port=config['redis']['port'],
+                **options)
+        __dbctx['async_redis'] = redis.asyncio.StrictRedis(
+            connection_pool=pool)
+    return __dbctx['async_redis']
+
+
 # vim: ts=4 sw=4 sts=4 expandtab
@@ -0,0 +1,619 @@
+#!/usr/bin/env python3
+import copy
+import time
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque, OrderedDict
+from datetime import datetime, timedelta
+
+from .models import Message, MessageType, MessagePriority, RichText, TextStyle
+from .config import config
+from .helpers import get_logger, get_now, tz
+
+logger = get_logger("Egress")
+
+
+def merge_rich_text(a: Message, b: Message, separator: str):
+    """\
+    rich_text of b appended to that of a, as their content is merged, None
+    if neither has any. Bots like Telegram format from rich_text when it is
+    set, so it must not keep only one side.
+    """
+    if a.rich_text is None and b.rich_text is None:
+        return None
+    text = []
+    for m in (a, b):
+        if text:
+            text.append((TextStyle(), separator))
+        if m.rich_text is not None:
+            text += m.rich_text
+        else:
+            text.append((TextStyle(), m.content))
+    return RichText(text)
+
+
+class OutboundQueue(object):
+    """\
+    Bounded queue between the bus reader and the sender of a bridge, so that
+    a slow IM does not make the bus buffer grow until redis drops the
+    subscriber.
+
+    Messages are queued by Message.priority, text is sent ahead of media
+    and events. To keep lower priorities flowing, after burst messages in a
+    row taken ahead of waiting lower priority ones, the oldest of those is
+    sent next.
+
+    When full, a message is dropped by the overflow policy:
+
+        drop_oldest: drop the oldest message of the lowest priority
+        drop_media: drop the oldest media message, or as drop_oldest if
+            there is none
+        collapse: merge the oldest text message into the next text message
+            of the same sender in the same room, or as drop_oldest if there
+            is none
+
+    With block, nothing is dropped, put waits for room instead. This is
+    for a bus keeping the backlog itself, like StreamMessageBus, whose
+    messages must not be lost between the bus and the IM.
+
+    Attributes:
+        maxsize: max number of queued messages
+        policy: overflow policy
+        burst: max number of messages taken ahead of lower priorities
+        metrics: Metrics of the bridge, or None
+        block: whether put waits for room instead of dropping
+    """
+
+    POLICIES = ("drop_oldest", "drop_media", "collapse")
+
+    def __init__(self, maxsize=1000, policy="drop_oldest", burst=8,
+                 metrics=None, block=False):
+        if policy not in self.POLICIES:
+            raise Exception("Unknown overflow policy: {}".format(policy))
+        self.maxsize = maxsize
+        self.policy = policy
+        self.burst = burst
+        self.metrics = metrics
+        self.block = block
+        self.error = None
+        # priority -> deque of (sequence number, message)
+        self._qs = {level: deque() for level in MessagePriority.levels}
+        self._size = 0
+        self._seq = 0
+        self._streak = 0
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return self._size
+
+    def _incr(self, field, n=1):
+        if self.metrics is not None:
+            self.metrics.incr(field, n)
+
+    def _depth(self):
+        if self.metrics is not None:
+            self.metrics.set("egress.depth", self._size)
+
+    def _drop_oldest(self):
+        for level in reversed(MessagePriority.levels):
+            if self._qs[level]:
+                self._qs[level].popleft()
+                self._size -= 1
+                return
+
+    def _collapse(self):
+        q = self._qs[MessagePriority.High]
+        if not q:
+            return False
+        _, first = q[0]
+        if first.mtype != MessageType.Text or "text_url" in first.opt:
+            return False
+        for _, msg in list(q)[1:]:
+            if msg.room == first.room and msg.channel == first.channel:
+                if msg.mtype == MessageType.Text and \
+                        "text_url" not in msg.opt and \
+                        msg.sender == first.sender and \
+                        msg.botmsg == first.botmsg:
+                    msg.rich_text = merge_rich_text(first, msg, "\n")
+                    msg.content = first.content + "\n" + msg.content
+                    msg.take_acks(first)
+                    q.popleft()
+                    self._size -= 1
+                    return True
+                break
+        return False
+
+    def _overflow(self):
+        if self.policy == "drop_media" and self._qs[MessagePriority.Media]:
+            self._qs[MessagePriority.Media].popleft()
+            self._size -= 1
+            self._incr("egress.dropped.media")
+            return
+        if self.policy == "collapse" and self._collapse():
+            self._incr("egress.collapsed")
+            return
+        self._drop_oldest()
+        self._incr("egress.dropped")
+
+    def put(self, msg: Message):
+        with self._cond:
+            if self.block:
+                while self._size >= self.maxsize:
+                    self._cond.wait()
+            elif self._size >= self.maxsize:
+                self._overflow()
+            self._seq += 1
+            self._qs[msg.priority].append((self._seq, msg))
+            self._size += 1
+            self._depth()
+            self._cond.notify_all()
+
+    def _next_level(self):
+        levels = [level for level in MessagePriority.levels if self._qs[level]]
+        if len(levels) == 1:
+            self._streak = 0
+            return levels[0]
+        if self._streak >= self.burst:
+            self._streak = 0
+            return min(levels[1:], key=lambda level: self._qs[level][0][0])
+        self._streak += 1
+        return levels[0]
+
+    def get(self, timeout=None) -> Message:
+        """\
+        Block until a message is queued, or for at most timeout seconds and
+        return None, raise the error of the reader if it has died and
+        nothing is left
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while not self._size:
+                if self.error is not None:
+                    raise self.error
+                if deadline is None:
+                    self._cond.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+            _, msg = self._qs[self._next_level()].popleft()
+            self._size -= 1
+            self._depth()
+            if self.block:
+                self._cond.notify_all()
+            return msg
+
+    def consume(self, stream):
+        """\
+        Queue messages from stream, e.g. MessageBus.message_stream()
+        """
+        try:
+            for msg in stream:
+                self.put(msg)
+        except Exception as e:
+            logger.exception("bus reader died")
+            with self._cond:
+                self.error = e
+                self._cond.notify_all()
+
+
+class StaleDigest(object):
+    """\
+    Skip messages older than max_age, e.g. a backlog replayed after an
+    outage, and send one digest per room instead, like "42 messages
+    skipped, see <chat log URL>". The digest of a room goes out before its
+    next fresh message, or from flush once no stale message of the room has
+    come for quiet seconds, so that a replay is summarized once even if the
+    reader falls behind now and then.
+
+    Attributes:
+        max_age: age in seconds, None to never skip
+        metrics: Metrics of the bridge, or None
+        quiet: seconds without stale messages of a room before its digest
+    """
+
+    DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+    def __init__(self, max_age=None, metrics=None, quiet=5):
+        self.max_age = max_age
+        self.metrics = metrics
+        self.quiet = quiet
+        # room -> (count, first, last message, time of the last)
+        self._skipped = OrderedDict()
+
+    def is_stale(self, msg: Message, now: datetime=None) -> bool:
+        if self.max_age is None or not (msg.date and msg.time):
+            return False
+        try:
+            sent = tz.localize(datetime.strptime(
+                msg.date + " " + msg.time, self.DATE_FORMAT))
+        except ValueError:
+            return False
+        now = now or get_now()
+        return now - sent > timedelta(seconds=self.max_age)
+
+    def digest(self, room) -> Message:
+        count, first, last, _ = self._skipped.pop(room)
+        url = "{baseurl}/log/{room}/{date}".format(
+            baseurl=config["baseurl"], room=room, date=first.date)
+        return Message(
+            last.channel, None, last.receiver,
+            "{} message{} skipped, see {}".format(
+                count, "" if count == 1 else "s", url),
+            mtype=MessageType.Event, date=last.date, time=last.time,
+            botmsg=True, room=room, route=last.route,
+        )
+
+    def filter(self, msg: Message, now=None) -> list:
+        """\
+        Messages to send in place of msg
+        """
+        if self.is_stale(msg):
+            now = time.time() if now is None else now
+            count, first, _, _ = self._skipped.get(
+                msg.room, (0, msg, None, None))
+            self._skipped[msg.room] = (count + 1, first, msg, now)
+            # taken care of by the digest
+            msg.ack()
+            if self.metrics is not None:
+                self.metrics.incr("egress.stale")
+            return []
+        if msg.room in self._skipped:
+            return [self.digest(msg.room), msg]
+        return [msg]
+
+    def flush(self, now=None) -> list:
+        """\
+        Digests of the rooms without stale messages for quiet seconds
+        """
+        now = time.time() if now is None else now
+        return [
+            self.digest(room)
+            for room, (_, _, _, seen) in list(self._skipped.items())
+            if now - seen >= self.quiet
+        ]
+
+    def wait_time(self, now=None):
+        """\
+        Seconds until the next digest is due in flush, None if none is
+        pending
+        """
+        if not self._skipped:
+            return None
+        now = time.time() if now is None else now
+        seen = min(seen for _, _, _, seen in self._skipped.values())
+        return max(0, seen + self.quiet - now)
+
+
+def coalescible(msg: Message) -> bool:
+    return msg.mtype == MessageType.Text and "text_url" not in msg.opt and \
+        len(msg.lines) == 1
+
+
+def coalesce(a: Message, b: Message, max_bytes=400, separator=" | "):
+    """\
+    Merge b into one line after a, if both are one-line text from the same
+    sender and the result is at most max_bytes long, or return None
+    """
+    if not (coalescible(a) and coalescible(b)):
+        return None
+    if (a.sender, a.botmsg, a.room, a.channel) != \
+            (b.sender, b.botmsg, b.room, b.channel) or "reply_to" in b.opt:
+        return None
+    content = a.content.strip() + separator + b.content.strip()
+    if len(content.encode('utf-8')) > max_bytes:
+        return None
+    merged = copy.copy(a)
+    merged.content = content
+    merged.rich_text = merge_rich_text(a, b, separator)
+    merged.take_acks(a)
+    merged.take_acks(b)
+    return merged
+
+
+class TargetLanes(object):
+    """\
+    Send messages on a worker pool, one lane per target (the chat a message
+    goes to), so that a slow send to one chat does not hold up the others.
+    Each lane is drained by at most one worker at a time, preserving order
+    within a target. At most max_pending messages are in the lanes, submit
+    blocks beyond that, so that a backlog stays in the OutboundQueue where
+    the overflow policy applies.
+
+    With a coalescing window, for bots sending line by line, a short text
+    waits up to window seconds for more from the same sender to the same
+    target, and they are sent as one line, see coalesce.
+
+    Extra arguments given to submit are passed on to send, such a message
+    is never coalesced.
+
+    Attributes:
+        send: function sending one message
+        max_workers: max number of concurrent sends
+        max_pending: max number of messages in the lanes
+        window: coalescing window in seconds, None to send right away
+        max_bytes: max length of a coalesced line
+    """
+
+    def __init__(self, send, max_workers=4, max_pending=None, metrics=None,
+                 window=None, max_bytes=400):
+        self.send = send
+        self.max_workers = max_workers
+        self.metrics = metrics
+        self.window = window
+        self.max_bytes = max_bytes
+        # target -> deque of (message, send args), present while active
+        self._lanes = {}
+        self._cond = threading.Condition()
+        self._pending = threading.BoundedSemaphore(
+            max_pending or 2 * max_workers)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def submit(self, target, msg: Message, *args):
+        self._pending.acquire()
+        with self._cond:
+            lane = self._lanes.get(target, None)
+            if lane is not None:
+                lane.append((msg, args))
+                self._cond.notify_all()
+                return
+            self._lanes[target] = deque(((msg, args), ))
+        self._executor.submit(self._drain, target)
+
+    def _coalesce(self, msg: Message, lane: deque) -> Message:
+        # called with self._cond held
+        deadline = time.time() + self.window
+        while True:
+            while lane:
+                following, args = lane[0]
+                merged = None if args else \
+                    coalesce(msg, following, self.max_bytes)
+                if merged is None:
+                    return msg
+                lane.popleft()
+                self._pending.release()
+                if self.metrics is not None:
+                    self.metrics.incr("egress.coalesced")
+                msg = merged
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                return msg
+            self._cond.wait(timeout)
+
+    def _drain(self, target):
+        while True:
+            with self._cond:
+                lane = self._lanes[target]
+                if not lane:
+                    del self._lanes[target]
+                    return
+                msg, args = lane.popleft()
+                if self.window and not args and coalescible(msg):
+                    msg = self._coalesce(msg, lane)
+            try:
+                self.send(msg, *args)
+            except:
+                logger.exception("failed to send message to {}".format(target))
+                if self.metrics is not None:
+                    self.metrics.incr("egress.failed")
+            finally:
+                self._pending.release()
+
+
+def egress_options(chantag) -> dict:
+    """\
+    Egress options of a bridge from config["egress"], where the options
+    under its ChanTag override the defaults, e.g.
+    {"maxsize": 1000, "irc": {"policy": "collapse"}}
+    """
+    options = dict(config.get("egress", {}))
+    options.update(options.pop(chantag, {}))
+    return options
+
+
+def get_outbound_queue(chantag, block=False) -> OutboundQueue:
+    """\
+    Create the outbound queue of a bridge from config["egress"], see
+    OutboundQueue for block
+    """
+    from .metrics import get_metrics
+    options = egress_options(chantag)
+    return OutboundQueue(
+        maxsize=options.get("maxsize", 1000),
+        policy=options.get("policy", "drop_oldest"),
+        burst=options.get("burst", 8),
+        metrics=get_metrics(chantag),
+        block=block,
+    )
+
+
+class _MessageTestCase(unittest.TestCase):
+
+    @staticmethod
+    def _msg(content, sender="a", mtype=MessageType.Text, receiver="-1",
+             **kwargs) -> Message:
+        return Message("telegram", sender, receiver, content, mtype=mtype,
+                       room="test", **kwargs)
+
+    def _msgs(self, *specs) -> list:
+        """\
+        Messages from (sender, content, mtype) specs
+        """
+        return [
+            self._msg(content, sender, mtype)
+            for sender, content, mtype in specs
+        ]
+
+
+class TestOutboundQueue(_MessageTestCase):
+
+    def test_drop_oldest(self):
+        q = OutboundQueue(maxsize=2)
+        for m in self._msgs(("a", "1", "text"), ("a", "2", "text"),
+                           ("a", "3", "text")):
+            q.put(m)
+        self.assertEqual([q.get().content for _ in range(2)], ["2", "3"])
+
+    def test_drop_media(self):
+        q = OutboundQueue(maxsize=2, policy="drop_media")
+        for m in self._msgs(("a", "1", "text"), ("a", "p", "photo"),
+                           ("a", "3", "text")):
+            q.put(m)
+        self.assertEqual([q.get().content for _ in range(2)], ["1", "3"])
+
+    def test_collapse(self):
+        q = OutboundQueue(maxsize=2, policy="collapse")
+        for m in self._msgs(("a", "1", "text"), ("a", "2", "text"),
+                           ("b", "3", "text")):
+            q.put(m)
+        self.assertEqual([q.get().content for _ in range(2)], ["1\n2", "3"])
+
+    def test_collapse_rich_text(self):
+        q = OutboundQueue(maxsize=2, policy="collapse")
+        m1, m2, m3 = self._msgs(("a", "1", "text"), ("a", "2", "text"),
+                               ("b", "3", "text"))
+        bold = TextStyle(bold=1)
+        m2.rich_text = RichText([(bold, "2")])
+        for m in (m1, m2, m3):
+            q.put(m)
+        merged = q.get()
+        self.assertEqual(merged.content, "1\n2")
+        self.assertEqual(merged.rich_text.toPlain(), "1\n2")
+        self.assertEqual(merged.rich_text[-1], (bold, "2"))
+
+    def test_block(self):
+        q = OutboundQueue(maxsize=1, block=True)
+        m1, m2 = self._msgs(("a", "1", "text"), ("a", "2", "text"))
+        q.put(m1)
+        t = threading.Thread(target=q.put, args=(m2, ), daemon=True)
+        t.start()
+        t.join(0.1)
+        self.assertTrue(t.is_alive())
+        self.assertEqual(q.get().content, "1")
+        t.join(1)
+        self.assertEqual(q.get().content, "2")
+
+    def test_priority(self):
+        q = OutboundQueue(burst=2)
+        for m in self._msgs(("a", "p1", "photo"), ("a", "e1", "event"),
+                           ("a", "p2", "photo"), ("a", "1", "text"),
+                           ("a", "2", "text"), ("a", "3", "text")):
+            q.put(m)
+        self.assertEqual([q.get().content for _ in range(6)],
+                         ["1", "2", "p1", "3", "p2", "e1"])
+
+    def test_get_timeout(self):
+        q = OutboundQueue()
+        self.assertIsNone(q.get(timeout=0.05))
+        q.put(self._msg("1"))
+        self.assertEqual(q.get(timeout=0.05).content, "1")
+
+    def test_reader_error(self):
+        def stream():
+            yield self._msg("1")
+            raise ConnectionError()
+
+        q = OutboundQueue()
+        q.consume(stream())
+        self.assertEqual(q.get().content, "1")
+        self.assertRaises(ConnectionError, q.get)
+
+
+class TestTargetLanes(_MessageTestCase):
+
+    def test_order_and_independence(self):
+        sent = []
+        blocked = threading.Event()
+
+        def send(msg):
+            if msg.receiver == "slow":
+                blocked.wait(5)
+            sent.append((msg.receiver, msg.content))
+
+        lanes = TargetLanes(send, max_workers=2)
+        lanes.submit("slow", self._msg("0", receiver="slow"))
+        for i in range(3):
+            lanes.submit("fast", self._msg(str(i), receiver="fast"))
+        time.sleep(0.2)
+        self.assertEqual(sent, [("fast", "0"), ("fast", "1"), ("fast", "2")])
+        blocked.set()
+        lanes._executor.shutdown(wait=True)
+        self.assertEqual(sent[-1], ("slow", "0"))
+
+    def test_coalesce(self):
+        sent, acked = [], []
+        lanes = TargetLanes(sent.append, window=0.2, max_bytes=12)
+        for sender, content in (("a", "hi"), ("a", "there"),
+                                ("a", "long line"), ("b", "yo")):
+            m = self._msg(content, sender)
+            m.on_ack(lambda content=content: acked.append(content))
+            lanes.submit("#test", m)
+        lanes._executor.shutdown(wait=True)
+        self.assertEqual(
+            [(m.sender, m.content) for m in sent],
+            [("a", "hi | there"), ("a", "long line"), ("b", "yo")],
+        )
+        for m in sent:
+            m.ack()
+        self.assertEqual(acked, ["hi", "there", "long line", "yo"])
+
+    def test_coalesce_rich_text(self):
+        a, b = self._msg("hi"), self._msg("there")
+        bold = TextStyle(bold=1)
+        b.rich_text = RichText([(bold, "there")])
+        merged = coalesce(a, b)
+        self.assertEqual(merged.rich_text.toPlain(), "hi | there")
+        self.assertEqual(merged.rich_text[-1], (bold, "there"))
+        self.assertIsNone(a.rich_text)
+        self.assertIsNone(coalesce(a, self._msg("again")).rich_text)
+
+    def test_send_args(self):
+        sent = []
+        lanes = TargetLanes(
+            lambda msg, *args: sent.append((msg.content, args)), window=0.2)
+        lanes.submit("#test", self._msg("hi"))
+        lanes.submit("#test", self._msg("retried"), 2, 1)
+        lanes.submit("#test", self._msg("there"))
+        lanes._executor.shutdown(wait=True)
+        self.assertEqual(
+            sent, [("hi", ()), ("retried", (2, 1)), ("there", ())])
+
+
+class TestStaleDigest(_MessageTestCase):
+
+    def test_digest(self):
+        now = get_now()
+        old = now - timedelta(seconds=600)
+
+        def dated_msg(content, d):
+            return self._msg(
+                content,
+                date=d.strftime("%Y-%m-%d"), time=d.strftime("%H:%M:%S"),
+                route={"irc": "#test", "telegram": "-1"},
+            )
+
+        s = StaleDigest(max_age=60)
+        self.assertEqual(s.filter(dated_msg("1", old)), [])
+        self.assertEqual(s.filter(dated_msg("2", old)), [])
+        digest, fresh = s.filter(dated_msg("3", now))
+        self.assertTrue(digest.content.startswith("2 messages skipped"))
+        self.assertIn("/log/test/" + old.strftime("%Y-%m-%d"), digest.content)
+        self.assertEqual(digest.route["telegram"], "-1")
+        self.assertEqual(fresh.content, "3")
+
+        # a replay with pauses shorter than quiet gets one digest
+        s.filter(dated_msg("4", old), now=0)
+        self.assertEqual(s.wait_time(now=1), 4)
+        self.assertEqual(s.flush(now=1), [])
+        s.filter(dated_msg("5", old), now=3)
+        self.assertEqual(s.flush(now=7), [])
+        digest, = s.flush(now=8)
+        self.assertTrue(digest.content.startswith("2 messages skipped"))
+        self.assertIsNone(s.wait_time())
+        self.assertEqual(
+            StaleDigest().filter(dated_msg("6", old))[0].content, "6")
+
+
+# vim: ts=4 sw=4 sts=4 expandtab
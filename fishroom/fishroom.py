@@ -1,31 +1,45 @@
 #!/usr/bin/env python3
 import re
 import os, sys
+import zlib
+import queue
 import signal
 import threading
 import time
 
-from .base import EmptyBot
-from .bus import MessageBus, MsgDirection
+from .base import EmptyBot, is_line_oriented
+from .bus import (
+    MsgDirection, StreamMessageBus, get_message_bus, get_bus_broker)
 from .models import MessageType, Message
 from .chatlogger import ChatLogger
-from .textstore import Pastebin, Vinergy, RedisStore, ChatLoggerStore
+from .textstore import (
+    Pastebin, Vinergy, RedisStore, ChatLoggerStore, PasteQueue
+)
 # from .telegram_tg import TgTelegram, TgTelegramThread
 from .api_client import APIClientManager
-from .command import get_command_handler, parse_command
+from .command import (
+    get_command_handler, parse_command, register_command, CommandExecutor)
+from .flood import get_flood_detector
 from .helpers import get_logger
 
 from .config import config
-from .db import get_redis
+from . import db
 
 
+def init_clients():
+    """\
+    Create the redis clients and what is built on them
+    """
+    global redis_client, msgs_from_im, msgs_to_im, chat_logger, api_mgr
+    redis_client = db.get_redis()
+    msgs_from_im = get_message_bus(redis_client, MsgDirection.im2fish)
+    msgs_to_im = get_message_bus(redis_client, MsgDirection.fish2im)
 
-redis_client = get_redis()
-msgs_from_im = MessageBus(redis_client, MsgDirection.im2fish)
-msgs_to_im = MessageBus(redis_client, MsgDirection.fish2im)
+    chat_logger = ChatLogger(redis_client)
+    api_mgr = APIClientManager(redis_client, cached=True)
 
-chat_logger = ChatLogger(redis_client)
-api_mgr = APIClientManager(redis_client)
+
+init_clients()
 
 logger = get_logger("Fishroom")
 
@@ -37,8 +51,9 @@ def load_plugins():
         import_module(module, package="fishroom")
 
 
-def init_text_store():
-    provider = config['text_store']['provider']
+def init_text_store(provider=None):
+    if provider is None:
+        provider = config['text_store']['provider']
     if provider == "pastebin":
         options = config['text_store']['options']
         return Pastebin(**options)
@@ -50,18 +65,115 @@ def init_text_store():
         return ChatLoggerStore()
 
 
-def main():
+def build_binding_index(bindings):
+    """\
+    Index bindings by (channel, receiver), and build the route of each room
+    once, shared by all of its messages (so never change a route in place).
+    Like a scan of bindings in order, the first room bound to a receiver wins.
+
+    Returns:
+        index: (channel, receiver) -> (room, binding)
+        routes: room -> route
+    """
+    index, routes = {}, {}
+    for room, b in bindings.items():
+        routes[room] = {c: t for c, t in b.items() if c != "flood"}
+        for c, t in b.items():
+            if isinstance(t, str):
+                index.setdefault((c, t), (room, b))
+    return index, routes
+
+
+def get_binding(binding_index, msg):
+    # channel tags are lowercase already, except for API clients
+    ret = binding_index.get((msg.channel, msg.receiver), None)
+    if ret is None:
+        ret = binding_index.get(
+            (msg.channel.lower(), msg.receiver), (None, None))
+    return ret
+
+
+SHARDS_KEY = config["redis"]["prefix"] + ":router:shards"
+
+
+def shard_of(room: str, workers: int) -> int:
+    # stable across processes, unlike hash()
+    return zlib.crc32(room.encode('utf-8')) % workers
+
+
+def shard_name(shard: int) -> str:
+    return "shard{}".format(shard)
+
+
+def router(msgs_from_im):
+    """\
+    Route messages from msgs_from_im: log them, deliver them to API clients,
+    handle commands, and publish them to IM
+    """
     load_plugins()
     text_store = init_text_store()
+    fallback = config['text_store'].get('fallback', None)
+    paste_queue = PasteQueue(
+        text_store, msgs_to_im.publish,
+        fallback=(init_text_store(fallback) if fallback else None),
+        max_workers=config['text_store'].get('workers', 4),
+    )
     bindings = config['bindings']
+    binding_index, routes = build_binding_index(bindings)
+
+    # messages from IM, and bot replies injected by command workers. At
+    # most inbox_size messages from IM wait here, the receiver blocks beyond
+    # that, bot replies are not counted since the router itself adds them
+    inbox = queue.Queue()
+    slots = threading.Semaphore(config.get("inbox_size", 1000))
 
-    def get_binding(msg):
-        for room, b in bindings.items():
-            if msg.receiver == b.get(msg.channel.lower(), None):
-                return room, b
-        return (None, None)
+    # on streams, a message is acked once routed, not once in the inbox
+    if isinstance(msgs_from_im, StreamMessageBus):
+        msgs_from_im.manual_ack = True
 
-    def try_command(msg):
+    def receive():
+        try:
+            for msg in msgs_from_im.message_stream():
+                slots.acquire()
+                inbox.put((msg, True))
+        except Exception:
+            logger.exception("failed to read messages from IM")
+        finally:
+            inbox.put((None, False))
+
+    def on_reply(bot_reply, msg, room):
+        opt = None
+        if isinstance(bot_reply, tuple) and len(bot_reply) == 2:
+            bot_reply, opt = bot_reply
+        bot_msg = Message(
+            msg.channel, config.get("name", "bot"), msg.receiver,
+            content=bot_reply, date=msg.date, time=msg.time,
+            botmsg=True, room=room, opt=opt
+        )
+        # bot replies will be furthor processed by the router
+        inbox.put((bot_msg, False))
+
+    cmd_options = config.get("command", {})
+    cmd_executor = CommandExecutor(
+        on_reply,
+        max_workers=cmd_options.get("workers", 4),
+        timeout=cmd_options.get("timeout", 10),
+        slow=cmd_options.get("slow", 1),
+    )
+
+    flood_detector = get_flood_detector(bindings)
+    if flood_detector is not None:
+        def flood_stats(cmd, *args, **kwargs):
+            if 'room' not in kwargs:
+                return None
+            return flood_detector.stats(kwargs['room'])
+
+        register_command(
+            "flood", flood_stats, desc="flood detection counters",
+            usage="flood", inline=True,
+        )
+
+    def try_command(msg, room):
         cmd, args = parse_command(msg.content)
         if cmd is None:
             msg.mtype = MessageType.Text
@@ -72,68 +184,171 @@ def main():
             msg.mtype = MessageType.Text
             return
 
+        if not handler.inline:
+            cmd_executor.submit(handler, cmd, args, msg, room)
+            return
+
         try:
-            return handler.func(cmd, *args, msg=msg, room=room)
+            bot_reply = handler.func(cmd, *args, msg=msg, room=room)
         except:
             logger.exception("failed to execute command: {}".format(cmd))
+            return
+        if bot_reply:
+            on_reply(bot_reply, msg, room)
 
-    for msg in msgs_from_im.message_stream():
+    def route(msg):
         logger.info(msg)
         if msg.room is None:
-            room, b = get_binding(msg)
+            room, b = get_binding(binding_index, msg)
             msg.room = room
         else:
             room = msg.room
             b = bindings.get(room, None)
 
         if b is None:
-            continue
+            return
 
+        # drop floods before they are fanned out
+        if flood_detector is not None:
+            allowed, notice = flood_detector.check(msg, room)
+            if notice is not None:
+                on_reply(notice, msg, room)
+            if not allowed:
+                return
+
+        # the chat log, the API log and the IM publish of a message go in
+        # one round trip, unless it waits for a paste URL, then the IM
+        # publish follows from the paste queue. The chat log RPUSH comes
+        # first, its result gives msg_id
+        p = redis_client.pipeline(transaction=False)
+        chat_logger.log(room, msg, pipe=p)
         # Deliver to api clients
-        api_mgr.publish(msg)
-        msg_id = chat_logger.log(room, msg)
+        api_mgr.publish(msg, pipe=p)
 
         # Handle commands
-        bot_reply = ""
         if msg.mtype == MessageType.Command:
-            bot_reply = try_command(msg)
-
-        if bot_reply:
-            opt = None
-            if isinstance(bot_reply, tuple) and len(bot_reply) == 2:
-                bot_reply, opt = bot_reply
-            bot_msg = Message(
-                msg.channel, config.get("name", "bot"), msg.receiver,
-                content=bot_reply, date=msg.date, time=msg.time,
-                botmsg=True, room=room, opt=opt
-            )
-            # bot replies will be furthor processed by this function
-            msgs_from_im.publish(bot_msg)
+            try_command(msg, room)
 
         # attach routing infomation
-        msg.route = {c: t for c, t in b.items()}
+        msg.route = routes[room]
 
-        # get url or for long text
+        # push to IM, get url for long text first if any bot needs it
         if (msg.content.count('\n') > 5 or
-                len(msg.content.encode('utf-8')) >= 400):
-            text_url = text_store.new_paste(
-                msg.content, msg.sender,
+                len(msg.content.encode('utf-8')) >= 400) and \
+                any(is_line_oriented(t) for t in msgs_to_im.targets(msg)):
+            msg_id = p.execute()[0] - 1
+            paste_queue.put(
+                room, msg,
                 channel=room, date=msg.date, time=msg.time, msg_id=msg_id
             )
+        else:
+            paste_queue.put(room, msg, pipe=p)
+            p.execute()
+
+    receiver = threading.Thread(target=receive, daemon=True)
+    receiver.start()
+
+    while True:
+        msg, from_im = inbox.get()
+        if msg is None:
+            break
+        route(msg)
+        if from_im:
+            msg.ack()
+            slots.release()
 
-            if text_url is None:
-                # Fail
-                logger.error("Failed to publish text")
-                continue
+    # exit non-zero, so that a supervisor restarts the core
+    logger.error("message stream from IM ended")
+    sys.exit(1)
 
-            msg.opt['text_url'] = text_url
 
-        # push to IM
-        msgs_to_im.publish(msg)
+def router_worker(shard: int):
+    # forked, do not share the connections and the API client cache of
+    # the parent
+    db.reset()
+    init_clients()
+    router(get_message_bus(
+        redis_client, MsgDirection.im2fish, shard_name(shard)))
+
+
+def dispatcher(workers: int):
+    """\
+    Resolve the room of each message from IM and pass it on to the router
+    worker owning that room, so that messages of a room stay in order while
+    rooms on different workers are routed in parallel.
+    """
+    binding_index, _ = build_binding_index(config['bindings'])
+
+    assignment = {
+        room: shard_of(room, workers) for room in config['bindings']
+    }
+    p = redis_client.pipeline()
+    p.delete(SHARDS_KEY)
+    if assignment:
+        p.hset(SHARDS_KEY, mapping=assignment)
+    p.execute()
+    for shard in range(workers):
+        logger.info("{} owns rooms: {}".format(
+            shard_name(shard),
+            ", ".join(r for r, s in assignment.items() if s == shard)
+        ))
+
+    # on pub/sub, messages passed on before a worker subscribes are lost
+    for shard in range(workers):
+        msgs_from_im.wait_subscribed(shard_name(shard))
+
+    for msg in msgs_from_im.message_stream():
+        if msg.room is None:
+            msg.room, _ = get_binding(binding_index, msg)
+        if msg.room is None:
+            continue
+        msgs_from_im.publish(
+            msg, targets=[shard_name(shard_of(msg.room, workers))])
+
+
+def main(workers=1):
+    api_mgr.subscribe_unscoped()
+
+    broker = get_bus_broker()
+    if broker is not None:
+        broker.serve_in_thread()
+        logger.info("bus broker listening on {}".format(broker.server_address))
+
+    if workers <= 1:
+        router(msgs_from_im)
+        return
+
+    import multiprocessing
+
+    procs = []
+    for shard in range(workers):
+        proc = multiprocessing.Process(
+            target=router_worker, args=(shard, ), name=shard_name(shard),
+            daemon=True,
+        )
+        proc.start()
+        procs.append(proc)
+
+    def watch():
+        for proc in procs:
+            proc.join()
+            logger.error("router worker {} died".format(proc.name))
+            os._exit(1)
+
+    threading.Thread(target=watch, daemon=True).start()
+    dispatcher(workers)
 
 
 if __name__ == "__main__":
-    main()
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="number of router processes, rooms are sharded among them",
+    )
+    args = parser.parse_args()
+
+    main(workers=args.workers)
 
 
 # vim: ts=4 sw=4 sts=4 expandtab
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+import threading
+import time
+import unittest
+from collections import deque
+
+from .models import Message
+from .config import config
+from .helpers import get_logger
+
+logger = get_logger("Flood")
+
+
+class SlidingWindow(object):
+    """\
+    Timestamps of events in the last period seconds
+    """
+
+    __slots__ = ("period", "events")
+
+    def __init__(self, period):
+        self.period = period
+        self.events = deque()
+
+    def hit(self, now) -> int:
+        """\
+        Record an event at now, return the number of events in the window
+        """
+        self.events.append(now)
+        return self.count(now)
+
+    def count(self, now) -> int:
+        while self.events and self.events[0] <= now - self.period:
+            self.events.popleft()
+        return len(self.events)
+
+
+class FloodDetector(object):
+    """\
+    Sliding-window flood detection on messages entering the core, before
+    they are logged, delivered to API clients and fanned out to IM.
+
+    A sender sending more than sender_count messages in sender_period
+    seconds is muted for mute seconds. A room getting more than room_count
+    messages in room_period seconds drops the excess. Both are announced
+    once with a notice instead of passing the flood on.
+
+    Thresholds come from config["flood"], overridden by the "flood" option of
+    a binding. Counters are kept in memory, with sharded router workers each
+    room, and so each sender in it, is checked by one worker only.
+
+    Attributes:
+        defaults: default thresholds
+        bindings: config["bindings"]
+    """
+
+    DEFAULTS = {
+        "sender_count": 8,
+        "sender_period": 10,
+        "room_count": 40,
+        "room_period": 10,
+        "mute": 60,
+    }
+
+    def __init__(self, defaults, bindings):
+        self.defaults = dict(self.DEFAULTS, **defaults)
+        self.bindings = bindings
+        self._senders = {}  # (room, sender) -> SlidingWindow
+        self._rooms = {}    # room -> SlidingWindow
+        self._muted = {}    # (room, sender) -> (until, dropped)
+        self._room_dropped = {}  # room -> dropped in the current flood
+        self._lock = threading.Lock()
+        self._checks = 0
+
+    def options(self, room) -> dict:
+        b = self.bindings.get(room, {})
+        return dict(self.defaults, **b.get("flood", {}))
+
+    @staticmethod
+    def sender_of(msg: Message) -> str:
+        return "{}:{}".format(msg.channel, msg.sender)
+
+    def check(self, msg: Message, room, now=None):
+        """\
+        Returns:
+            allowed: whether msg should be passed on
+            notice: text to announce in room, or None
+        """
+        if msg.botmsg:
+            return True, None
+        now = time.time() if now is None else now
+        opts = self.options(room)
+        key = (room, self.sender_of(msg))
+
+        with self._lock:
+            self._checks += 1
+            if self._checks % 1000 == 0:
+                self._prune(now)
+
+            muted = self._muted.get(key, None)
+            if muted is not None:
+                until, dropped = muted
+                if now < until:
+                    self._muted[key] = (until, dropped + 1)
+                    return False, None
+                del self._muted[key]
+                if dropped:
+                    logger.info("{} unmuted in {}, {} messages dropped".format(
+                        key[1], room, dropped))
+
+            sw = self._senders.get(key, None)
+            if sw is None:
+                sw = self._senders[key] = SlidingWindow(opts["sender_period"])
+            if sw.hit(now) > opts["sender_count"]:
+                self._muted[key] = (now + opts["mute"], 1)
+                logger.warning("muted {} in {}".format(key[1], room))
+                return False, (
+                    "{} is flooding, muted for {} seconds"
+                    .format(msg.sender, opts["mute"])
+                )
+
+            rw = self._rooms.get(room, None)
+            if rw is None:
+                rw = self._rooms[room] = SlidingWindow(opts["room_period"])
+            if rw.hit(now) > opts["room_count"]:
+                dropped = self._room_dropped.get(room, 0)
+                self._room_dropped[room] = dropped + 1
+                if dropped == 0:
+                    logger.warning("room {} flooded".format(room))
+                    return False, (
+                        "too many messages, dropping some for {} seconds"
+                        .format(opts["room_period"])
+                    )
+                return False, None
+            self._room_dropped.pop(room, None)
+
+        return True, None
+
+    def _prune(self, now):
+        # called with self._lock held
+        for windows in (self._senders, self._rooms):
+            for k in [k for k, w in windows.items() if w.count(now) == 0]:
+                del windows[k]
+        for k in [k for k, (until, _) in self._muted.items() if until <= now]:
+            del self._muted[k]
+
+    def stats(self, room, now=None) -> str:
+        """\
+        Counters of room, for the flood command
+        """
+        now = time.time() if now is None else now
+        opts = self.options(room)
+        with self._lock:
+            rw = self._rooms.get(room, None)
+            lines = ["room: {}/{} messages in {}s".format(
+                rw.count(now) if rw else 0, opts["room_count"],
+                opts["room_period"])]
+            senders = sorted(
+                ((w.count(now), s) for (r, s), w in self._senders.items()
+                 if r == room),
+                reverse=True,
+            )
+            lines += [
+                "{}: {}/{} in {}s".format(
+                    s, n, opts["sender_count"], opts["sender_period"])
+                for n, s in senders[:5] if n > 0
+            ]
+            lines += [
+                "{}: muted for {}s, {} dropped".format(
+                    s, int(until - now), dropped)
+                for (r, s), (until, dropped) in self._muted.items()
+                if r == room and until > now
+            ]
+        return "\n".join(lines)
+
+
+def get_flood_detector(bindings):
+    """\
+    Create the flood detector from config["flood"], None if neither it nor
+    any binding sets flood options
+    """
+    options = config.get("flood", None)
+    if options is None and \
+            not any("flood" in b for b in bindings.values()):
+        return None
+    return FloodDetector(options or {}, bindings)
+
+
+class TestFloodDetector(unittest.TestCase):
+
+    def test_sender_mute(self):
+        d = FloodDetector(
+            {"sender_count": 2, "sender_period": 10, "mute": 30},
+            {"test": {"flood": {"sender_count": 3}}},
+        )
+        m = Message("irc", "spammer", "#test", "spam")
+        checks = [d.check(m, "test", now=t) for t in range(4)]
+        self.assertEqual([c[0] for c in checks], [True, True, True, False])
+        self.assertIn("spammer is flooding", checks[3][1])
+        # the default threshold applies to other rooms
+        self.assertEqual(
+            [d.check(m, "other", now=0)[0] for _ in range(3)],
+            [True, True, False])
+        self.assertEqual(d.check(m, "test", now=20), (False, None))
+        self.assertIn("2 dropped", d.stats("test", now=20))
+        self.assertEqual(d.check(m, "test", now=40), (True, None))
+
+    def test_room_flood(self):
+        d = FloodDetector({"room_count": 2, "sender_count": 10}, {})
+        checks = [
+            d.check(Message("irc", str(i), "#test", "hi"), "test", now=i)
+            for i in range(4)
+        ]
+        self.assertEqual([c[0] for c in checks], [True, True, False, False])
+        self.assertIsNotNone(checks[2][1])
+        self.assertIsNone(checks[3][1])
+        self.assertEqual(
+            d.check(Message("irc", "a", "#test", "hi"), "test", now=100),
+            (True, None))
+
+
+# vim: ts=4 sw=4 sts=4 expandtab
@@ -6,8 +6,8 @@ import aiohttp
 import requests
 import requests.exceptions
 
-from .bus import MessageBus, MsgDirection
-from .base import BaseBotInstance, EmptyBot
+from .bus import MessageBus, MsgDirection, get_message_bus
+from .base import BaseBotInstance, EmptyBot, must_send
 from .models import MessageType, Message, ChannelType
 from .helpers import string_date_time, get_logger
 from .config import config
@@ -18,7 +18,6 @@ logger = get_logger("Gitter")
 class Gitter(BaseBotInstance):
 
     ChanTag = ChannelType.Gitter
-    SupportMultiline = True
 
     _stream_api = "https://stream.gitter.im/v1/rooms/{room}/chatMessages"
     _post_api = "https://api.gitter.im/v1/rooms/{room}/chatMessages"
@@ -122,7 +121,7 @@ class Gitter(BaseBotInstance):
             'text': reply + text.format(sender=sender, content=content)
         }
 
-        self._must_post(url, json=j, headers=self.headers)
+        must_send("Gitter", self._must_post, url, json=j, headers=self.headers)
 
     def send_to_bus(self, msg):
         raise NotImplementedError()
@@ -161,15 +160,15 @@ def Gitter2FishroomThread(gt: Gitter, bus: MessageBus):
 def Fishroom2GitterThread(gt: Gitter, bus: MessageBus):
     if gt is None or isinstance(gt, EmptyBot):
         return
-    for msg in bus.message_stream():
-        gt.forward_msg_from_fishroom(msg)
+    gt.forward_msgs_from_bus(bus)
 
 
 def init():
     from .db import get_redis
     redis_client = get_redis()
-    im2fish_bus = MessageBus(redis_client, MsgDirection.im2fish)
-    fish2im_bus = MessageBus(redis_client, MsgDirection.fish2im)
+    im2fish_bus = get_message_bus(redis_client, MsgDirection.im2fish)
+    fish2im_bus = get_message_bus(
+        redis_client, MsgDirection.fish2im, ChannelType.Gitter)
 
     rooms = [b["gitter"] for _, b in config['bindings'].items() if 'gitter' in b]
     token = config['gitter']['token']
@@ -3,7 +3,7 @@
 from matrix_client.client import MatrixClient
 from matrix_client.api import MatrixRequestError
 from requests.exceptions import MissingSchema
-from .bus import MessageBus, MsgDirection
+from .bus import MessageBus, MsgDirection, get_message_bus
 from .base import BaseBotInstance, EmptyBot
 from .models import Message, ChannelType, MessageType
 from .helpers import get_now_date_time, get_logger
@@ -16,7 +16,6 @@ logger = get_logger("Matrix")
 class MatrixHandle(BaseBotInstance):
 
     ChanTag = ChannelType.Matrix
-    SupportMultiline = True
 
     def __init__(self, server, username, password, rooms, nick=None):
         client = MatrixClient(server)
@@ -144,15 +143,15 @@ def Matrix2FishroomThread(mx: MatrixHandle, bus: MessageBus):
 def Fishroom2MatrixThread(mx: MatrixHandle, bus: MessageBus):
     if mx is None or isinstance(mx, EmptyBot):
         return
-    for msg in bus.message_stream():
-        mx.forward_msg_from_fishroom(msg)
+    mx.forward_msgs_from_bus(bus)
 
 
 def init():
     from .db import get_redis
     redis_client = get_redis()
-    im2fish_bus = MessageBus(redis_client, MsgDirection.im2fish)
-    fish2im_bus = MessageBus(redis_client, MsgDirection.fish2im)
+    im2fish_bus = get_message_bus(redis_client, MsgDirection.im2fish)
+    fish2im_bus = get_message_bus(
+        redis_client, MsgDirection.fish2im, ChannelType.Matrix)
 
     rooms = [b["matrix"] for _, b in config['bindings'].items() if "matrix" in b]
     server = config['matrix']['server']
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+import threading
+import time
+
+from .config import config
+from .helpers import get_logger
+
+logger = get_logger("Metrics")
+
+
+class Metrics(object):
+    """\
+    Counters and gauges of a process, kept in memory and flushed periodically
+    to the redis hash "fishroom:metrics:<name>", so that recording one
+    costs no round trip.
+
+    Attributes:
+        r: redis client
+        name: name of the process, e.g. the ChanTag of a bridge
+    """
+
+    key_tmpl = config["redis"]["prefix"] + ":metrics:{name}"
+
+    def __init__(self, redis_client, name):
+        self.r = redis_client
+        self.name = name
+        self.key = self.key_tmpl.format(name=name)
+        self._counters = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def incr(self, field, n=1):
+        with self._lock:
+            self._counters[field] = self._counters.get(field, 0) + n
+
+    def set(self, field, value):
+        with self._lock:
+            self._gauges[field] = value
+
+    def flush(self):
+        with self._lock:
+            counters, self._counters = self._counters, {}
+            gauges, self._gauges = self._gauges, {}
+        if not (counters or gauges):
+            return
+        p = self.r.pipeline(transaction=False)
+        for field, n in counters.items():
+            p.hincrby(self.key, field, n)
+        if gauges:
+            p.hset(self.key, mapping=gauges)
+        p.execute()
+
+    def start(self, interval=10):
+        """\
+        Start flushing every interval seconds in a daemon thread
+        """
+        if self._thread is not None:
+            return
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.flush()
+                except:
+                    logger.exception("failed to flush metrics")
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+
+
+_metrics = {}
+
+
+def get_metrics(name) -> Metrics:
+    """\
+    Metrics of name, shared in the process and flushed in the background
+    """
+    if name not in _metrics:
+        from .db import get_redis
+        m = Metrics(get_redis(), name)
+        m.start(config.get("metrics", {}).get("interval", 10))
+        _metrics[name] = m
+    return _metrics[name]
+
+
+if __name__ == "__main__":
+    from .db import get_redis
+    r = get_redis()
+    prefix = Metrics.key_tmpl.format(name="")
+    for key in sorted(r.scan_iter(match=prefix + "*")):
+        print(key.decode('utf-8')[len(prefix):])
+        for field, value in sorted(r.hgetall(key).items()):
+            print("  {}: {}".format(
+                field.decode('utf-8'), value.decode('utf-8')))
+
+
+# vim: ts=4 sw=4 sts=4 expandtab
@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 import re
+import json
 import unittest
+from collections import OrderedDict
 from marshmallow import Schema, fields, validate, ValidationError
 
 
@@ -34,6 +36,17 @@ class MessageType(object):
     Command = "command"
 
 
+class MessagePriority(object):
+    """\
+    Priority classes of messages, lower is more urgent
+    """
+    High = 0    # text, commands and bot messages
+    Media = 1   # photos, stickers, files and the like
+    Event = 2   # join/leave events
+
+    levels = (High, Media, Event)
+
+
 class Color(object):
     """\
     Text color option
@@ -63,6 +76,19 @@ class Color(object):
         self.fg, self.bg = self.bg, self.fg
 
 
+def _parse_color(value):
+    """\
+    Color from its serialized form, an int or (fg, bg), None if empty.
+    Raises an exception if value is invalid.
+    """
+    if not value:
+        return None
+    elif isinstance(value, int):
+        return Color(value)
+    fg, bg = map(int, value)
+    return Color(fg, bg)
+
+
 class ColorField(fields.Field):
 
     def _serialize(self, value, attr, obj):
@@ -71,17 +97,11 @@ class ColorField(fields.Field):
         return (value.fg, value.bg)
 
     def _deserialize(self, value, attr, obj):
-        if not value:
-            return None
-        elif isinstance(value, int):
-            return Color(value)
-        else:
-            try:
-                fg, bg = map(int, value)
-            except:
-                raise ValidationError(
-                    "Color field should only contain fg and bg")
-            return Color(fg, bg)
+        try:
+            return _parse_color(value)
+        except:
+            raise ValidationError(
+                "Color field should only contain fg and bg")
     # def __str__(self):
     #     return json.dumps({'fg': self.fg, 'bg': self.bg})
 
@@ -248,6 +268,9 @@ class TextStyleSchema(Schema):
     color = ColorField(missing=None)
     style = TextStyleField(missing=[])
 
+    class Meta:
+        ordered = True
+
 
 TextStyle._schema = TextStyleSchema()
 
@@ -314,6 +337,14 @@ class RichTextField(fields.Field):
                 "RichText should be a list of style and content")
 
 
+_MESSAGE_TYPES = (
+    MessageType.Photo, MessageType.Text, MessageType.Sticker,
+    MessageType.Location, MessageType.Audio, MessageType.Command,
+    MessageType.Event, MessageType.File, MessageType.Animation,
+    MessageType.Video,
+)
+
+
 class MessageSchema(Schema):
     """\
     Json Schema for Message
@@ -326,12 +357,7 @@ class MessageSchema(Schema):
     # message receiver (usually group id)
     receiver = fields.String()
     # message type
-    mtype = fields.String(validate=validate.OneOf(
-        (MessageType.Photo, MessageType.Text, MessageType.Sticker,
-         MessageType.Location, MessageType.Audio, MessageType.Command,
-         MessageType.Event, MessageType.File, MessageType.Animation,
-         MessageType.Video),
-    ))
+    mtype = fields.String(validate=validate.OneOf(_MESSAGE_TYPES))
     # if message is photo or sticker, this contains url
     media_url = fields.String()
     # message text
@@ -350,6 +376,64 @@ class MessageSchema(Schema):
     # available on fishroom to IM direction, specify message route
     route = fields.Dict()
 
+    class Meta:
+        ordered = True
+
+
+_STYLE_NAMES = (
+    ("italic", TextStyle.ITALIC),
+    ("bold", TextStyle.BOLD),
+    ("underline", TextStyle.UNDERLINE),
+)
+
+
+def _str_field(value):
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return str(value)
+
+
+def _dump_text_style(ts: TextStyle) -> OrderedDict:
+    """\
+    Same output as TextStyleSchema.dump, without validation
+    """
+    color = ts.color
+    return OrderedDict((
+        ("color", '' if color is None else (color.fg, color.bg)),
+        ("style", [] if ts.style is None else TextStyle.style_list(ts.style)),
+    ))
+
+
+def _load_text_style(data: dict) -> TextStyle:
+    """\
+    Same result as TextStyle.load, invalid color or style is ignored
+    """
+    if not isinstance(data, dict):
+        # rare, leave it to the schema
+        return TextStyle.load(data)
+
+    kwargs = {}
+    try:
+        color = _parse_color(data.get("color", None))
+    except:
+        pass
+    else:
+        if color is not None:
+            kwargs["color"] = color
+
+    style = TextStyle.NORMAL
+    try:
+        names = set(data.get("style", ()))
+    except TypeError:
+        names = ()
+    for name, mask in _STYLE_NAMES:
+        if name in names:
+            style |= mask
+    kwargs["style"] = style
+    return TextStyle(**kwargs)
+
 
 class Message(object):
     """\
@@ -367,27 +451,85 @@ class Message(object):
         botmsg: msg is from fishroom bot
         route: message route info
         opt: channel specific options
+
+    (De)serialization takes a hand-written fast path producing the same JSON
+    as MessageSchema. Set `validating` to True to go through the marshmallow
+    schema instead, which validates every field on the way.
+
+    Serialized forms are memoized until a field is assigned. Changing opt,
+    route or rich_text in place is not noticed, assign a new value instead.
+
+    A bus keeping messages until they are handled, see StreamMessageBus,
+    registers callbacks with on_ack, which ack() runs once the message has
+    been sent or otherwise taken care of.
     """
 
     _schema = MessageSchema()
+    validating = False
+
+    _str_fields = ("channel", "sender", "receiver", "media_url", "content",
+                   "date", "time", "room")
+    _fields = frozenset(
+        _str_fields + ("mtype", "rich_text", "botmsg", "route", "opt"))
 
     def __init__(self, channel, sender, receiver, content,
                  mtype=MessageType.Text, date=None, time=None,
                  media_url=None, botmsg=False, room=None, opt=None, route=None,
                  rich_text=None):
-        self.channel = channel
-        self.sender = sender
-        self.receiver = receiver
-        self.content = content
-        self.rich_text = rich_text
-        self.mtype = mtype
-        self.date = date
-        self.time = time
-        self.media_url = media_url
-        self.botmsg = botmsg
-        self.route = route
-        self.room = room
-        self.opt = opt or {}
+        # nothing is memoized yet, skip the invalidating __setattr__
+        self.__dict__.update(
+            channel=channel,
+            sender=sender,
+            receiver=receiver,
+            content=content,
+            rich_text=rich_text,
+            mtype=mtype,
+            date=date,
+            time=time,
+            media_url=media_url,
+            botmsg=botmsg,
+            route=route,
+            room=room,
+            opt=opt or {},
+        )
+
+    def __setattr__(self, name, value):
+        if name in self._fields:
+            self.__dict__.pop('_cache', None)
+        super(Message, self).__setattr__(name, value)
+
+    def __copy__(self):
+        # a copy starts with no memoized forms, or it would share them, and
+        # no ack callbacks, or they would run twice
+        m = self.__class__.__new__(self.__class__)
+        m.__dict__.update(self.__dict__)
+        m.__dict__.pop('_cache', None)
+        m.__dict__.pop('_acks', None)
+        return m
+
+    def on_ack(self, callback):
+        self.__dict__.setdefault('_acks', []).append(callback)
+
+    def take_acks(self, other: "Message"):
+        """\
+        Ack other along with this message, which other was merged into
+        """
+        if other is not self:
+            self.__dict__.setdefault('_acks', []).extend(
+                other.__dict__.pop('_acks', ()))
+
+    def ack(self):
+        for callback in self.__dict__.pop('_acks', ()):
+            callback()
+
+    def cached(self, key, func):
+        """\
+        Return func(), memoized under key until a field is assigned
+        """
+        cache = self.__dict__.setdefault('_cache', {})
+        if key not in cache:
+            cache[key] = func()
+        return cache[key]
 
     def __repr__(self):
         return (
@@ -397,8 +539,76 @@ class Message(object):
                 receiver=self.receiver, content=self.content,
             ))
 
+    def dump(self) -> OrderedDict:
+        if self.validating:
+            return self._schema.dump(self).data
+
+        rich_text = self.rich_text
+        if rich_text is not None:
+            rich_text = [(_dump_text_style(s), t) for s, t in rich_text.text]
+
+        return OrderedDict((
+            ("channel", _str_field(self.channel)),
+            ("sender", _str_field(self.sender)),
+            ("receiver", _str_field(self.receiver)),
+            ("mtype", _str_field(self.mtype)),
+            ("media_url", _str_field(self.media_url)),
+            ("content", _str_field(self.content)),
+            ("rich_text", rich_text),
+            ("date", _str_field(self.date)),
+            ("time", _str_field(self.time)),
+            ("botmsg", None if self.botmsg is None else bool(self.botmsg)),
+            ("room", _str_field(self.room)),
+            ("opt", self.opt),
+            ("route", self.route),
+        ))
+
     def dumps(self):
-        return self._schema.dumps(self).data
+        return self.cached(("dumps", self.validating), self._dumps)
+
+    def _dumps(self):
+        if self.validating:
+            return self._schema.dumps(self).data
+        return json.dumps(self.dump())
+
+    @classmethod
+    def load(cls, data: dict):
+        """\
+        Build a message from deserialized JSON data. Like the non-strict
+        schema, invalid fields are dropped and fall back to their defaults.
+        """
+        if cls.validating:
+            return Message(**cls._schema.load(data).data)
+
+        kwargs = {}
+        for k in cls._str_fields:
+            v = data.get(k, None)
+            if isinstance(v, str):
+                kwargs[k] = v
+
+        mtype = data.get("mtype", None)
+        if mtype in _MESSAGE_TYPES:
+            kwargs["mtype"] = mtype
+
+        botmsg = data.get("botmsg", None)
+        if isinstance(botmsg, bool):
+            kwargs["botmsg"] = botmsg
+
+        for k in ("opt", "route"):
+            v = data.get(k, None)
+            if isinstance(v, dict):
+                kwargs[k] = v
+
+        rich_text = data.get("rich_text", None)
+        if rich_text is not None:
+            try:
+                kwargs["rich_text"] = RichText(
+                    [(_load_text_style(s), t) for s, t in rich_text])
+            except:
+                # as RichTextField does
+                pass
+
+        return Message(**kwargs)
 
     @classmethod
     def loads(cls, jstr):
@@ -406,8 +616,9 @@ class Message(object):
             jstr = jstr.decode('utf-8')
 
         try:
-            m = Message(**cls._schema.loads(jstr).data)
-            return m
+            if cls.validating:
+                return Message(**cls._schema.loads(jstr).data)
+            return cls.load(json.loads(jstr))
         except:
             return Message("fishroom", "fishroom", "None", "Error")
 
@@ -418,6 +629,14 @@ class Message(object):
             if not re.match(r'^\s*$', line)
         ]
 
+    @property
+    def priority(self) -> int:
+        if self.botmsg or self.mtype in (MessageType.Text, MessageType.Command):
+            return MessagePriority.High
+        if self.mtype == MessageType.Event:
+            return MessagePriority.Event
+        return MessagePriority.Media
+
 
 class TestRichText(unittest.TestCase):
 
@@ -472,6 +691,79 @@ class TestRichText(unittest.TestCase):
         print(m, m.rich_text)
 
 
+class TestMessageSerialization(unittest.TestCase):
+
+    def setUp(self):
+        self.msgs = [
+            Message(
+                ChannelType.IRC, "tester", "#test", "hello world",
+                date="2017-01-01", time="12:00:00",
+                rich_text=RichText([
+                    (TextStyle(color=Color(3, 5), bold=1), "[tester] "),
+                    (TextStyle(italic=1, underline=1), "hello"),
+                    (TextStyle(), " world"),
+                ]),
+            ),
+            Message(
+                ChannelType.Telegram, "tester", "-1001", "a photo",
+                mtype=MessageType.Photo, media_url="http://example.com/a.png",
+                botmsg=True, room="test", opt={"text_url": "http://a.b/c"},
+                route={"irc": "#test", "telegram": "-1001"},
+            ),
+        ]
+
+    def tearDown(self):
+        Message.validating = False
+
+    def test_same_json_as_schema(self):
+        for m in self.msgs:
+            self.assertEqual(m.dumps(), Message._schema.dumps(m).data)
+
+    def test_same_message_as_schema(self):
+        for m in self.msgs:
+            jstr = m.dumps()
+            fast = Message.loads(jstr)
+            Message.validating = True
+            slow = Message.loads(jstr)
+            Message.validating = False
+            self.assertEqual(fast.__dict__, slow.__dict__)
+
+    def test_invalid_fields_dropped(self):
+        m = Message.loads(
+            '{"channel": "irc", "sender": "a", "receiver": "b", '
+            '"content": "c", "mtype": "nope", "room": null, "opt": 1}')
+        self.assertEqual(m.mtype, MessageType.Text)
+        self.assertIsNone(m.room)
+        self.assertEqual(m.opt, {})
+        self.assertEqual(Message.loads('{"channel": "irc"}').content, "Error")
+
+    def test_invalid_rich_text_as_schema(self):
+        for rich_text in (
+                [[{"color": "red", "style": ["bold"]}, "a"]],
+                [[{"color": [1, 2, 3]}, "a"], [{"color": 5}, "b"]],
+                [[{"color": [1, "x"], "style": 1}, "a"]],
+                [["bold", "a"]],
+                [[None, "a"]],
+                "bold"):
+            jstr = json.dumps({
+                "channel": "irc", "sender": "a", "receiver": "b",
+                "content": "c", "rich_text": rich_text,
+            })
+            fast = Message.loads(jstr)
+            Message.validating = True
+            slow = Message.loads(jstr)
+            Message.validating = False
+            self.assertEqual(fast.rich_text, slow.rich_text)
+
+    def test_memoized_dumps(self):
+        m = self.msgs[1]
+        jstr = m.dumps()
+        self.assertIs(m.dumps(), jstr)
+        m.route = {"irc": "#test"}
+        self.assertIsNot(m.dumps(), jstr)
+        self.assertEqual(m.dumps(), Message._schema.dumps(m).data)
+
+
 if __name__ == '__main__':
 
     unittest.main()
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 # -*- coding:utf-8 -*-
+import time
 from datetime import timedelta
 from collections import Counter
 
@@ -42,7 +43,10 @@ def hualao(cmd, *args, **kwargs):
 
     c = Counter()
     today = get_now()
+    deadline = kwargs.get('deadline', None)
     for _ in range(days):
+        if deadline is not None and time.time() > deadline:
+            return
         key = log_key_tmpl.format(date=today.strftime("%Y-%m-%d"), channel=room)
         senders = [Message.loads(bmsg).sender for bmsg in r.lrange(key, 0, -1)]
         c.update(senders)
@@ -7,7 +7,8 @@ from ..command import command
 url_regex = re.compile(r'https?://[^\s<>"]+')
 
 
-@command("imglink", desc="set message type as image", usage="imglink <link>")
+@command("imglink", desc="set message type as image", usage="imglink <link>",
+         inline=True)
 def imglink(cmd, *args, **kwargs):
     msg = kwargs.get("msg", None)
     if msg is None:
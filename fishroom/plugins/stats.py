@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 # -*- coding:utf-8 -*-
+import time
 from datetime import datetime, timedelta
 from collections import Counter
 from statistics import mean, stdev
@@ -40,7 +41,10 @@ def hualao(cmd, *args, **kwargs):
     today = get_now()
     day = today
     c = Counter()
+    deadline = kwargs.get('deadline', None)
     for _ in range(days):
+        if deadline is not None and time.time() > deadline:
+            return
         key = log_key_tmpl.format(date=day.strftime("%Y-%m-%d"), channel=room)
         senders = [Message.loads(bmsg).sender for bmsg in r.lrange(key, 0, -1)]
         c.update(senders)
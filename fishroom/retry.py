@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+import json
+import random
+import threading
+import time
+import unittest
+import uuid
+
+from .models import Message
+from .config import config
+from .helpers import get_logger
+
+logger = get_logger("Retry")
+
+
+class RetrySchedule(object):
+    """\
+    Failed sends of a bridge, kept in a redis sorted set scored by the time
+    of their next attempt, and retried with exponential backoff and jitter
+    by a background worker. Sends failing max_attempts times go to a capped
+    dead-letter list, from which they can be replayed.
+
+    Attributes:
+        r: redis client
+        name: ChanTag of the bridge
+        max_attempts: number of attempts before giving up
+        base_delay: delay in seconds before the first retry, doubled on
+            every following one
+        max_delay: max delay in seconds between attempts
+        dead_max: max length of the dead-letter list
+    """
+
+    schedule_key_tmpl = config["redis"]["prefix"] + ":retry:{name}"
+    dead_key_tmpl = config["redis"]["prefix"] + ":dead_letters:{name}"
+
+    def __init__(self, r, name, max_attempts=5, base_delay=2, max_delay=600,
+                 dead_max=1000):
+        self.r = r
+        self.name = name
+        self.schedule_key = self.schedule_key_tmpl.format(name=name)
+        self.dead_key = self.dead_key_tmpl.format(name=name)
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.dead_max = dead_max
+        self._thread = None
+
+    def delay(self, attempts: int) -> float:
+        d = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        # jitter spreads retries of one outage over time
+        return d * random.uniform(0.5, 1.0)
+
+    def schedule(self, msg: Message, line=0, error="", attempts=0,
+                 now=None):
+        """\
+        Schedule msg for a retry from line on, or move it to the dead
+        letters once it has been attempted max_attempts times
+        """
+        attempts += 1
+        entry = json.dumps({
+            "id": uuid.uuid4().hex,
+            "msg": msg.dump(),
+            "line": line,
+            "attempts": attempts,
+            "error": error,
+        })
+        if attempts >= self.max_attempts:
+            logger.error("giving up sending to {} after {} attempts: {}".format(
+                self.name, attempts, error))
+            p = self.r.pipeline(transaction=False)
+            p.lpush(self.dead_key, entry)
+            p.ltrim(self.dead_key, 0, self.dead_max - 1)
+            p.execute()
+            return
+        now = time.time() if now is None else now
+        self.r.zadd(self.schedule_key, {entry: now + self.delay(attempts)})
+
+    def due(self, now=None, count=32) -> list:
+        """\
+        Claim entries due by now, an entry is claimed by the worker whose
+        ZREM removes it
+        """
+        now = time.time() if now is None else now
+        entries = self.r.zrangebyscore(
+            self.schedule_key, "-inf", now, start=0, num=count)
+        return [
+            json.loads(e.decode('utf-8')) for e in entries
+            if self.r.zrem(self.schedule_key, e)
+        ]
+
+    def drain(self, send, now=None) -> int:
+        """\
+        Retry the due entries with send(msg, start_line, attempts), return
+        the number of entries tried. A send failing later, e.g. one handed
+        on to another thread, schedules the message again with attempts.
+        """
+        from .base import SendError
+        entries = self.due(now)
+        for entry in entries:
+            msg = Message.load(entry["msg"])
+            try:
+                send(msg, entry["line"], entry["attempts"])
+            except SendError as e:
+                self.schedule(msg, e.line, str(e), entry["attempts"])
+            except:
+                logger.exception("failed to retry sending to {}".format(
+                    self.name))
+        return len(entries)
+
+    def start(self, send, interval=1):
+        """\
+        Drain the schedule every interval seconds in a daemon thread
+        """
+        if self._thread is not None:
+            return
+
+        def run():
+            while True:
+                try:
+                    if self.drain(send) > 0:
+                        continue
+                except:
+                    logger.exception("failed to drain retry schedule")
+                time.sleep(interval)
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+
+    def scheduled(self) -> list:
+        return [
+            (json.loads(e.decode('utf-8')), score)
+            for e, score in self.r.zrange(
+                self.schedule_key, 0, -1, withscores=True)
+        ]
+
+    def dead_letters(self) -> list:
+        return [
+            json.loads(e.decode('utf-8'))
+            for e in self.r.lrange(self.dead_key, 0, -1)
+        ]
+
+    def replay(self, count=None) -> int:
+        """\
+        Move the count oldest dead letters, or all of them, back to the
+        schedule with a fresh number of attempts
+        """
+        n = 0
+        while count is None or n < count:
+            e = self.r.rpop(self.dead_key)
+            if e is None:
+                break
+            entry = json.loads(e.decode('utf-8'))
+            entry["attempts"] = 0
+            self.r.zadd(self.schedule_key, {json.dumps(entry): time.time()})
+            n += 1
+        return n
+
+    def purge(self):
+        self.r.delete(self.dead_key)
+
+
+def get_retry_schedule(chantag) -> RetrySchedule:
+    """\
+    Create the retry schedule of a bridge from config["retry"]
+    """
+    from .db import get_redis
+    options = config.get("retry", {})
+    return RetrySchedule(
+        get_redis(), chantag,
+        max_attempts=options.get("max_attempts", 5),
+        base_delay=options.get("base_delay", 2),
+        max_delay=options.get("max_delay", 600),
+        dead_max=options.get("dead_max", 1000),
+    )
+
+
+class TestRetrySchedule(unittest.TestCase):
+
+    def test_retry_and_dead_letter(self):
+        try:
+            import fakeredis
+        except ImportError:
+            self.skipTest("fakeredis is not installed")
+        from .base import SendError
+
+        s = RetrySchedule(fakeredis.FakeStrictRedis(), "irc", max_attempts=2)
+        m = Message("telegram", "a", "-1", "1\n2\n3", room="test")
+        s.schedule(m, line=1, error="timeout")
+        self.assertEqual(s.drain(lambda *args: None, now=0), 0)
+
+        calls = []
+
+        def send(msg, line, attempts):
+            calls.append((msg.content, line))
+            raise SendError("timeout", line=2)
+
+        self.assertEqual(s.drain(send, now=time.time() + 3600), 1)
+        self.assertEqual(calls, [("1\n2\n3", 1)])
+        dead, = s.dead_letters()
+        self.assertEqual((dead["line"], dead["attempts"]), (2, 2))
+
+        self.assertEqual(s.replay(), 1)
+        entry, _ = s.scheduled()[0]
+        self.assertEqual((entry["line"], entry["attempts"]), (2, 0))
+        self.assertEqual(s.dead_letters(), [])
+
+
+if __name__ == "__main__":
+    import sys
+    import argparse
+    from datetime import datetime
+
+    parser = argparse.ArgumentParser("Retry schedule and dead letters")
+    parser.add_argument('bridge', help="ChanTag of the bridge, e.g. telegram")
+    subparsers = parser.add_subparsers(dest="command", help="valid subcommands")
+    subparsers.add_parser('list', aliases=['l'], help="list scheduled retries")
+    subparsers.add_parser('dead', aliases=['d'], help="list dead letters")
+    sp = subparsers.add_parser(
+        'replay', aliases=['r'], help="schedule dead letters again")
+    sp.add_argument('-n', '--count', type=int, default=None,
+                    help='number of dead letters, oldest first (default all)')
+    subparsers.add_parser('purge', help="delete all dead letters")
+    subparsers.add_parser('help', help="print help")
+
+    args = parser.parse_args()
+
+    if args.command in ("help", None):
+        parser.print_help()
+        sys.exit(0)
+
+    schedule = get_retry_schedule(args.bridge)
+
+    def format_entry(entry):
+        msg = entry["msg"]
+        return "{} [{}] {}: {!r} (line {}, {} attempts, {})".format(
+            msg.get("room"), msg.get("channel"), msg.get("sender"),
+            msg.get("content", "")[:40], entry["line"], entry["attempts"],
+            entry["error"],
+        )
+
+    if args.command in ("list", "l"):
+        for entry, score in schedule.scheduled():
+            print("{} {}".format(
+                datetime.fromtimestamp(score).strftime("%Y-%m-%d %H:%M:%S"),
+                format_entry(entry)))
+
+    elif args.command in ("dead", "d"):
+        for entry in schedule.dead_letters():
+            print(format_entry(entry))
+
+    elif args.command in ("replay", "r"):
+        print("{} dead letters scheduled".format(schedule.replay(args.count)))
+
+    elif args.command == "purge":
+        schedule.purge()
+        print("dead letters purged")
+
+
+# vim: ts=4 sw=4 sts=4 expandtab
@@ -13,13 +13,13 @@ import unittest
 import traceback
 
 from collections import namedtuple
-from .base import BaseBotInstance, EmptyBot
+from .base import BaseBotInstance, EmptyBot, SendError, must_send
 from .photostore import BasePhotoStore
 from .filestore import BaseFileStore
 from .models import (
     Message, ChannelType, MessageType, RichText, TextStyle, Color
 )
-from .bus import MessageBus, MsgDirection
+from .bus import MessageBus, MsgDirection, get_message_bus
 from .helpers import (
     timestamp_date_time, get_now_date_time, webp2png, md5, get_logger,
 )
@@ -155,8 +155,6 @@ class RedisStickerURLStore(BaseStickerURLStore):
 class Telegram(BaseBotInstance):
 
     ChanTag = ChannelType.Telegram
-    SupportMultiline = True
-    SupportPhoto = True
 
     _api_base_tmpl = "https://api.telegram.org/bot{token}"
     _file_base_tmpl = "https://api.telegram.org/file/bot{token}/"
@@ -603,18 +601,25 @@ class Telegram(BaseBotInstance):
         except:
             return
 
+        def reply(target, content):
+            # best effort, this runs on the receiving thread
+            try:
+                self.send_msg(target, content)
+            except SendError:
+                logger.exception("failed to reply to nick command")
+
         if cmd == "nick":
             if len(args) == 1:
                 nick = args[0]
                 if not re.match(r'^\w', nick, flags=re.UNICODE):
-                    self.send_msg(target, "Use a human's nick name, please.")
+                    reply(target, "Use a human's nick name, please.")
                     return True
                 self.nick_store.set_nickname(user_id, nick)
                 content = "Changed nickname to '%s'" % nick
                 logger.debug(target, content)
-                self.send_msg(target, content)
+                reply(target, content)
             else:
-                self.send_msg(
+                reply(
                     target,
                     "Invalid Command, use '/nick nickname'"
                     "to change nickname."
@@ -632,7 +637,7 @@ class Telegram(BaseBotInstance):
         filename = "image." + ft
         data = {'chat_id': target, 'caption': caption}
         files = {'photo': (filename, photo_data)}
-        self._must_post(api, data=data, files=files)
+        must_send("Telegram", self._must_post, api, data=data, files=files)
 
     def send_msg(self, peer, content, sender=None, escape=True, rich_text=None,
                  **kwargs):
@@ -664,7 +669,7 @@ class Telegram(BaseBotInstance):
         if 'telegram' in kwargs:
             for k, v in kwargs['telegram'].items():
                 data[k] = v
-        self._must_post(api, json=data)
+        must_send("Telegram", self._must_post, api, json=data)
 
     def msg_tmpl(self, sender=None):
         return "{content}" if sender is None else "<b>[{sender}]</b> {content}"
@@ -696,8 +701,7 @@ def Telegram2FishroomThread(tg: Telegram, bus: MessageBus):
 def Fishroom2TelegramThread(tg: Telegram, bus: MessageBus):
     if tg is None or isinstance(tg, EmptyBot):
         return
-    for msg in bus.message_stream():
-        tg.forward_msg_from_fishroom(msg)
+    tg.forward_msgs_from_bus(bus)
 
 
 def init():
@@ -734,8 +738,9 @@ def init():
             file_store=file_store,
         )
 
-    im2fish_bus = MessageBus(redis_client, MsgDirection.im2fish)
-    fish2im_bus = MessageBus(redis_client, MsgDirection.fish2im)
+    im2fish_bus = get_message_bus(redis_client, MsgDirection.im2fish)
+    fish2im_bus = get_message_bus(
+        redis_client, MsgDirection.fish2im, ChannelType.Telegram)
     return tg, im2fish_bus, fish2im_bus
 
 
@@ -18,6 +18,9 @@ TeleMessage = namedtuple(
 class TgTelegram(BaseBotInstance):
 
     ChanTag = ChannelType.Telegram
+    # sends neither photos nor multiline messages, unlike the bot API
+    SupportMultiline = False
+    SupportPhoto = False
 
     def __init__(self, ip_addr='127.0.0.1', port='4444', nick_store=None):
         self._socket_init(ip_addr, port)
@@ -4,6 +4,9 @@ import requests
 import requests.exceptions
 import hashlib
 import json
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from .helpers import get_now
 from .config import config
 from .helpers import get_logger
@@ -119,11 +122,88 @@ class ChatLoggerStore(BaseTextStore):
         channel = kwargs.get("channel", None)
         date = kwargs.get("date", None)
         msg_id = kwargs.get("msg_id", None)
-        if not (channel and date and msg_id):
+        if not (channel and date and msg_id is not None):
             return None
         return self.URL_TMPL.format(
             channel=channel,
             date=date, msg_id=msg_id,
         )
 
+
+class PasteQueue(object):
+    """\
+    Create pastes for long messages on a bounded thread pool, so that a slow
+    text store does not hold up routing. Messages of a room are delivered
+    in the order they were put: those behind a pending paste wait for it,
+    while other rooms keep flowing.
+
+    Attributes:
+        store: text store to create pastes
+        deliver: called with each message once it is ready to go, and
+            a redis pipeline (or None) to queue the commands on
+        fallback: text store to use when store fails, e.g. ChatLoggerStore
+    """
+
+    def __init__(self, store: BaseTextStore, deliver, fallback=None,
+                 max_workers=4):
+        self.store = store
+        self.deliver = deliver
+        self.fallback = fallback
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        # room -> deque of (msg, future of paste url or None)
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def put(self, room, msg, pipe=None, **paste_kwargs):
+        """\
+        Queue a message, a paste of its content is created first if
+        paste_kwargs (passed to new_paste) are given. If the message can go
+        right away and pipe is given, it is delivered on the redis pipeline.
+        """
+        with self.lock:
+            q = self.pending.get(room, None)
+            if not (q or paste_kwargs):
+                self.deliver(msg, pipe=pipe)
+                return
+
+            fut = None
+            if paste_kwargs:
+                fut = self.pool.submit(self.paste, msg, **paste_kwargs)
+            self.pending.setdefault(room, deque()).append((msg, fut))
+
+        if fut is not None:
+            fut.add_done_callback(lambda _: self.flush(room))
+
+    def paste(self, msg, **kwargs):
+        stores = [self.store] + ([self.fallback] if self.fallback else [])
+        for store in stores:
+            try:
+                url = store.new_paste(msg.content, msg.sender, **kwargs)
+            except:
+                logger.exception("Failed to create paste")
+                url = None
+            if url is not None:
+                return url
+        return None
+
+    def flush(self, room):
+        # deliver under the lock, or two flushes could interleave
+        with self.lock:
+            q = self.pending.get(room, None)
+            while q and (q[0][1] is None or q[0][1].done()):
+                msg, fut = q.popleft()
+                if fut is not None:
+                    text_url = fut.result()
+                    if text_url is None:
+                        logger.error("Failed to publish text")
+                        continue
+                    # assign a new dict so that the memoized dumps is invalidated
+                    msg.opt = dict(msg.opt, text_url=text_url)
+                try:
+                    self.deliver(msg, pipe=None)
+                except:
+                    logger.exception("Failed to deliver message")
+            if not q:
+                self.pending.pop(room, None)
+
 # vim: ts=4 sw=4 sts=4 expandtab
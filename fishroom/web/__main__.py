@@ -1,14 +1,43 @@
 #!/usr/bin/env python3
+import time
 import tornado.ioloop
 import tornado.web
 from .handlers import (
     DefaultHandler, TextStoreHandler, ChatLogHandler, MessageStreamHandler,
     PostMessageHandler, APILongPollingHandler, APIPostMessageHandler,
-    RobotsTxtHandler, GitHubOAuth2LoginHandler
+    RobotsTxtHandler, GitHubOAuth2LoginHandler, logger
 )
+from ..metrics import get_metrics
 from ..config import config
 
 
+def watch_ioloop_lag(interval=1.0, slow=0.1):
+    """\
+    Measure how late the IOLoop runs a callback scheduled interval seconds
+    ahead, a loop blocked by a handler shows up as lag. Reported as the
+    "ioloop.lag_ms" and "ioloop.lag_max_ms" gauges of the "web" metrics,
+    and "ioloop.stalls" counts lags over slow seconds.
+    """
+    loop = tornado.ioloop.IOLoop.current()
+    metrics = get_metrics("web")
+    state = {"max": 0.0}
+
+    def check(expected):
+        lag = max(time.monotonic() - expected, 0.0)
+        state["max"] = max(state["max"], lag)
+        metrics.set("ioloop.lag_ms", int(lag * 1000))
+        metrics.set("ioloop.lag_max_ms", int(state["max"] * 1000))
+        if lag > slow:
+            metrics.incr("ioloop.stalls")
+            logger.warning("IOLoop lagged {:.3f}s".format(lag))
+        schedule()
+
+    def schedule():
+        loop.call_later(interval, check, time.monotonic() + interval)
+
+    schedule()
+
+
 def main():
     debug = config.get("debug", False)
     application = tornado.web.Application([
@@ -24,7 +53,8 @@ def main():
     ], debug=debug, autoreload=debug, login_url='/login', cookie_secret=config['cookie_secret'])
     application.listen(config['chatlog']['port'],address=config['chatlog'].get('host', '0.0.0.0'))
     print("Serving on",config['chatlog'].get('host', '0.0.0.0'),":",format(config['chatlog']['port']))
-    tornado.ioloop.IOLoop.instance().start()
+    watch_ioloop_lag()
+    tornado.ioloop.IOLoop.current().start()
 
 
 if __name__ == "__main__":
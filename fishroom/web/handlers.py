@@ -5,38 +5,51 @@ import re
 import tornado.escape
 import tornado.web
 import tornado.websocket
-import tornado.gen as gen
-import tornadoredis
+from tornado.ioloop import IOLoop
 
 import hashlib
 from urllib.parse import urlparse, urljoin, urlencode
 from datetime import datetime, timedelta
 from .oauth import GitHubOAuth2Mixin
-from ..db import get_redis as get_pyredis
+from ..db import get_redis as get_pyredis, get_async_redis
 from ..base import BaseBotInstance
-from ..bus import MessageBus, MsgDirection
-from ..helpers import get_now, tz
+from ..bus import MsgDirection, get_message_bus
+from ..helpers import get_now, tz, get_logger
 from ..models import Message, ChannelType, MessageType
 from ..chatlogger import ChatLogger
 from ..api_client import APIClientManager
 from ..config import config
+from .hub import RoomHub, ViewerBuffer
 
 
-def get_redis():
-    if config['redis'].get('unix_socket_path') is not None:
-        r = tornadoredis.Client(
-            unix_socket_path=config['redis']['unix_socket_path'])
-    else:
-        r = tornadoredis.Client(
-            host=config['redis']['host'], port=config['redis']['port'])
+logger = get_logger("Web")
 
-    r.connect()
-    return r
-
-r = get_redis()
+r = get_async_redis()
 pr = get_pyredis()
 
-mgb_im2fish = MessageBus(pr, MsgDirection.im2fish)
+mgb_im2fish = get_message_bus(pr, MsgDirection.im2fish)
+
+# websocket viewers share one redis subscription per room
+hub = RoomHub(r)
+
+api_mgr = APIClientManager(pr, cached=True)
+
+
+async def publish_im2fish(msg):
+    # the bus client is blocking, keep it off the IOLoop
+    await IOLoop.current().run_in_executor(None, mgb_im2fish.publish, msg)
+
+
+async def api_registry():
+    """\
+    The cached registry of API clients, None if it cannot be kept in sync
+    """
+    registry = api_mgr.registry(load=False)
+    if registry is None:
+        # loading is blocking, keep it off the IOLoop
+        registry = await IOLoop.current().run_in_executor(
+            None, api_mgr.registry)
+    return registry
 
 
 def authenticated(method):
@@ -60,10 +73,9 @@ class BaseHandler(tornado.web.RequestHandler):
 class GitHubOAuth2LoginHandler(tornado.web.RequestHandler,
                                GitHubOAuth2Mixin):
 
-    @gen.coroutine
-    def get(self):
+    async def get(self):
         if self.get_argument('code', False):
-            logged_in = yield self.get_authenticated_user(code=self.get_argument('code'))
+            logged_in = await self.get_authenticated_user(code=self.get_argument('code'))
             if logged_in:
                 self.set_secure_cookie('session', 'ok')
                 self.redirect(self.get_argument('next', '/'))
@@ -71,7 +83,7 @@ class GitHubOAuth2LoginHandler(tornado.web.RequestHandler,
                 self.set_status(401)
                 self.finish('Unauthorized')
         else:
-            yield self.authorize_redirect(
+            self.authorize_redirect(
                 redirect_uri=config['baseurl'] + '/login?next=' + self.get_argument('next', '/'),
                 client_id=config['github']['client_id'],
             )
@@ -98,11 +110,10 @@ class RobotsTxtHandler(tornado.web.RequestHandler):
 class TextStoreHandler(BaseHandler):
 
     @authenticated
-    @gen.coroutine
-    def get(self, room, date, msg_id):
+    async def get(self, room, date, msg_id):
         key = ChatLogger.LOG_QUEUE_TMPL.format(channel=room, date=date)
         msg_id = int(msg_id)
-        val = pr.lrange(key, msg_id, msg_id)
+        val = await r.lrange(key, msg_id, msg_id)
         if not val:
             self.clear()
             self.set_status(404)
@@ -121,8 +132,7 @@ class TextStoreHandler(BaseHandler):
 class ChatLogHandler(BaseHandler):
 
     @authenticated
-    @gen.coroutine
-    def get(self, room, date):
+    async def get(self, room, date):
         if room not in config["bindings"] or \
                 room in config.get("private_rooms", []):
             self.set_status(404)
@@ -143,7 +153,7 @@ class ChatLogHandler(BaseHandler):
         embedded = self.get_argument("embedded", None)
 
         key = ChatLogger.LOG_QUEUE_TMPL.format(channel=room, date=date)
-        mlen = pr.llen(key)
+        mlen = await r.llen(key)
 
         last = int(self.get_argument("last", mlen)) - 1
         limit = int(self.get_argument("limit", 15 if embedded else mlen))
@@ -151,7 +161,7 @@ class ChatLogHandler(BaseHandler):
         start = max(last - limit + 1, 0)
 
         if self.get_argument("json", False):
-            logs = pr.lrange(key, start, last)
+            logs = await r.lrange(key, start, last)
             msgs = [json.loads(jmsg.decode("utf-8")) for jmsg in logs]
             for i, m in zip(range(start, last+1), msgs):
                 m['id'] = i
@@ -201,7 +211,7 @@ class PostMessageHandler(BaseHandler):
         self.write(json.dumps(kwargs))
 
     @authenticated
-    def post(self, room):
+    async def post(self, room):
         if room not in config["bindings"] or \
                 room in config.get("private_rooms", []):
             self.set_status(404)
@@ -249,7 +259,7 @@ class PostMessageHandler(BaseHandler):
             mtype=mtype, date=date, time=time, room=room
         )
 
-        mgb_im2fish.publish(msg)
+        await publish_im2fish(msg)
         self.write_json(200, msg="OK")
         self.finish()
 
@@ -258,50 +268,38 @@ class MessageStreamHandler(tornado.websocket.WebSocketHandler):
 
     def __init__(self, *args, **kwargs):
         super(MessageStreamHandler, self).__init__(*args, **kwargs)
-        self.r = None
+        self.room = None
+        self.viewer = ViewerBuffer(
+            self, config['chatlog'].get('ws_buffer', 100))
 
     def check_origin(self, origin):
         return True
 
     def on_message(self, jmsg):
+        if self.room is not None:
+            return
         try:
             msg = json.loads(jmsg)
-            self.r = get_redis()
             room = msg["room"]
             if room not in config["bindings"] or \
                     room in config.get("private_rooms", []):
                 self.close()
                 return
-            self._listen(room)
+            self.room = room
+            IOLoop.current().spawn_callback(hub.join, room, self.viewer)
         except:
             self.close()
 
-    @gen.engine
-    def _listen(self, room):
-        self.redis_chan = ChatLogger.CHANNEL.format(channel=room)
-        yield gen.Task(self.r.subscribe, self.redis_chan)
-        self.r.listen(self._on_update)
-
-    @gen.coroutine
-    def _on_update(self, msg):
-        if msg.kind == "message":
-            self.write_message(msg.body)
-        elif msg.kind == "subscribe":
-            self.write_message("OK")
-        elif msg.kind == "disconnect":
-            self.close()
-
     def on_close(self):
-        if self.r:
-            if self.r.subscribed:
-                self.r.unsubscribe(self.redis_chan)
-            self.r.disconnect()
+        if self.room is not None:
+            IOLoop.current().spawn_callback(hub.leave, self.room, self.viewer)
+        if self.viewer.dropped:
+            logger.info("dropped {} messages to a slow viewer of {}".format(
+                self.viewer.dropped, self.room))
 
 
 class APIRequestHandler(tornado.web.RequestHandler):
 
-    mgr = APIClientManager(pr)
-
     def set_default_headers(self):
         self.set_header("Content-Type", "application/json")
 
@@ -309,7 +307,7 @@ class APIRequestHandler(tornado.web.RequestHandler):
         self.set_status(status_code)
         self.write(json.dumps(kwargs))
 
-    def auth(self):
+    async def auth(self):
         token_id = self.request.headers.get(
             "X-TOKEN-ID",
             self.get_argument("id", "")
@@ -318,8 +316,13 @@ class APIRequestHandler(tornado.web.RequestHandler):
             "X-TOKEN-KEY",
             self.get_argument("key", "")
         )
-        fine = self.mgr.auth(token_id, token_key)
-        if not fine:
+        registry = await api_registry()
+        if registry is not None:
+            valid = api_mgr.verify(registry, token_id, token_key)
+        else:
+            saved = await r.hget(APIClientManager.clients_key, token_id)
+            valid = APIClientManager.check_key(token_key, saved)
+        if not valid:
             self.set_status(403)
             return
         return token_id
@@ -327,9 +330,8 @@ class APIRequestHandler(tornado.web.RequestHandler):
 
 class APILongPollingHandler(APIRequestHandler):
 
-    @gen.coroutine
-    def get(self):
-        token_id = self.auth()
+    async def get(self):
+        token_id = await self.auth()
         if token_id is None:
             self.finish("Invalid Token")
             return
@@ -341,22 +343,56 @@ class APILongPollingHandler(APIRequestHandler):
             self.finish("Room not found")
             return
 
-        queue = APIClientManager.queue_key.format(token_id=token_id)
-        l = yield gen.Task(r.llen, queue)
-        msgs = []
-        if l > 0:
-            msgs = yield gen.Task(r.lrange, queue, 0, -1)
-            pr.delete(queue)
-            msgs = [json.loads(m) for m in msgs]
+        registry = await api_registry()
+        if registry is not None:
+            subscribed = registry.is_subscribed(token_id, room)
         else:
-            ret = yield gen.Task(r.blpop, queue, timeout=10)
-            if queue in ret:
-                msgs = [json.loads(ret[queue])]
+            rooms_key = APIClientManager.rooms_key.format(token_id=token_id)
+            p = r.pipeline(transaction=False)
+            p.sismember(rooms_key, room)
+            p.sismember(rooms_key, APIClientManager.ALL_ROOMS)
+            subscribed = any(await p.execute())
+        if not subscribed:
+            self.write_json(403, message="Not subscribed to room")
+            self.finish()
+            return
 
-        if room:
-            msgs = [m for m in msgs if m['room'] == room]
+        key = APIClientManager.log_key.format(room=room)
+        cursor_key = APIClientManager.cursor_key.format(
+            token_id=token_id, room=room)
+
+        # clients may keep their own cursor, or rely on the one kept here
+        since = self.get_argument("since", None)
+        if since is None:
+            since = await r.get(cursor_key)
+            since = since.decode('utf-8') if since else None
+        elif not re.match(r'^\d+(-\d+)?$', since):
+            self.write_json(400, message="Invalid cursor")
+            self.finish()
+            return
+        try:
+            limit = max(1, min(int(self.get_argument("limit", 100)), 1000))
+        except ValueError:
+            self.write_json(400, message="Invalid limit")
+            self.finish()
+            return
+        if since is None:
+            # a new client starts with messages after now
+            last = await r.xrevrange(key, count=1)
+            since = last[0][0].decode('utf-8') if last else "0-0"
+
+        ret = await r.xread({key: since}, count=limit, block=10000)
+        entries = ret[0][1] if ret else []
 
-        self.write_json(messages=msgs)
+        msgs = []
+        for entry_id, fields in entries:
+            m = json.loads(fields[b'msg'].decode('utf-8'))
+            m['id'] = entry_id.decode('utf-8')
+            msgs.append(m)
+        cursor = msgs[-1]['id'] if msgs else since
+        await r.set(cursor_key, cursor, ex=APIClientManager.cursor_ttl)
+
+        self.write_json(messages=msgs, cursor=cursor)
         self.finish()
 
 
@@ -375,14 +411,14 @@ class APIPostMessageHandler(APIRequestHandler):
         self.write_json(400, message="Cannot handle empty request")
         self.finish()
 
-    def post(self, room):
+    async def post(self, room):
         if room not in config["bindings"] or \
                 room in config.get("private_rooms", []):
             self.set_status(404)
             self.finish("Room not found")
             return
 
-        token_id = self.auth()
+        token_id = await self.auth()
         if token_id is None:
             self.finish("Invalid Token")
             return
@@ -391,8 +427,14 @@ class APIPostMessageHandler(APIRequestHandler):
         if not content:
             self.write_json(400, message="Cannot send empty message")
             self.finish()
+            return
 
-        apiname = self.mgr.get_name(token_id)
+        registry = await api_registry()
+        if registry is not None:
+            apiname = registry.names.get(token_id, None)
+        else:
+            apiname = await r.hget(APIClientManager.clients_name_key, token_id)
+            apiname = apiname.decode('utf-8') if apiname else None
         sender = self.json_data.get("sender", apiname)
         now = get_now()
         date, time = now.strftime("%Y-%m-%d"), now.strftime("%H:%M:%S")
@@ -405,6 +447,6 @@ class APIPostMessageHandler(APIRequestHandler):
             mtype=mtype, date=date, time=time, room=room
         )
 
-        mgb_im2fish(msg)
+        await publish_im2fish(msg)
         self.write_json(message="OK")
         self.finish()
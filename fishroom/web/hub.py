@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+import asyncio
+from collections import deque
+
+import tornado.websocket
+from tornado.ioloop import IOLoop
+
+from ..chatlogger import ChatLogger
+from ..helpers import get_logger
+
+logger = get_logger("WebHub")
+
+
+class RoomHub(object):
+    """\
+    Fan-out of chat log updates to websocket viewers: one redis subscription
+    per room with viewers, on a single pub/sub connection shared by all
+    rooms. A room is unsubscribed when its last viewer leaves.
+
+    Viewers are objects with push(data) and close(), see ViewerBuffer.
+
+    Attributes:
+        r: redis.asyncio client
+    """
+
+    def __init__(self, r):
+        self.r = r
+        self.pubsub = r.pubsub()
+        self.viewers = {}  # channel -> set of viewers
+        self._reader = None
+        self._lock = None
+
+    @property
+    def lock(self):
+        # created on first use, inside the running loop, since a lock
+        # created at import time may be bound to another loop
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    @staticmethod
+    def channel_of(room):
+        return ChatLogger.CHANNEL.format(channel=room)
+
+    async def join(self, room, viewer):
+        chan = self.channel_of(room)
+        async with self.lock:
+            viewers = self.viewers.get(chan, None)
+            if viewers is None:
+                await self.pubsub.subscribe(chan)
+                viewers = self.viewers[chan] = set()
+            viewers.add(viewer)
+            if self._reader is None:
+                self._reader = asyncio.ensure_future(self._read())
+        viewer.push("OK")
+
+    async def leave(self, room, viewer):
+        chan = self.channel_of(room)
+        async with self.lock:
+            viewers = self.viewers.get(chan, None)
+            if viewers is None or viewer not in viewers:
+                return
+            viewers.discard(viewer)
+            if not viewers:
+                del self.viewers[chan]
+                await self.pubsub.unsubscribe(chan)
+
+    async def _read(self):
+        try:
+            while self.viewers:
+                try:
+                    msg = await self.pubsub.get_message(
+                        ignore_subscribe_messages=True, timeout=1.0)
+                except Exception:
+                    logger.exception("lost redis subscription")
+                    await self._resubscribe()
+                    continue
+                if msg is None or msg['type'] != "message":
+                    continue
+                chan = msg['channel'].decode('utf-8')
+                data = msg['data'].decode('utf-8')
+                for viewer in list(self.viewers.get(chan, ())):
+                    viewer.push(data)
+        finally:
+            self._reader = None
+
+    async def _resubscribe(self):
+        """\
+        Replace the pub/sub connection and subscribe the rooms with viewers
+        again, or close all viewers if that fails. Holds the lock, so that
+        a join or leave meanwhile is not lost with the old connection.
+        """
+        async with self.lock:
+            try:
+                await self.pubsub.reset()
+                self.pubsub = self.r.pubsub()
+                if self.viewers:
+                    await self.pubsub.subscribe(*self.viewers)
+                return
+            except Exception:
+                logger.exception("failed to resubscribe, closing all viewers")
+            viewers = {v for vs in self.viewers.values() for v in vs}
+            self.viewers = {}
+            self.pubsub = self.r.pubsub()
+        for viewer in viewers:
+            viewer.close()
+
+
+class ViewerBuffer(object):
+    """\
+    Send buffer of a websocket viewer, so that a slow client does not hold
+    up the others. When more than maxlen messages are waiting, the oldest
+    are dropped.
+
+    Attributes:
+        ws: WebSocketHandler
+        maxlen: max number of waiting messages
+        dropped: number of messages dropped
+    """
+
+    def __init__(self, ws, maxlen=100):
+        self.ws = ws
+        self.buf = deque(maxlen=maxlen)
+        self.dropped = 0
+        self.sending = False
+
+    def push(self, data):
+        if len(self.buf) == self.buf.maxlen:
+            self.dropped += 1
+        self.buf.append(data)
+        if not self.sending:
+            self.sending = True
+            IOLoop.current().spawn_callback(self.flush)
+
+    async def flush(self):
+        try:
+            while self.buf:
+                await self.ws.write_message(self.buf.popleft())
+        except tornado.websocket.WebSocketClosedError:
+            self.buf.clear()
+        finally:
+            self.sending = False
+
+    def close(self):
+        self.ws.close()
+
+
+# vim: ts=4 sw=4 sts=4 expandtab
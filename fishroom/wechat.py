@@ -6,7 +6,7 @@ import itchat
 from itchat.content import TEXT,MAP,CARD,NOTE,SHARING,PICTURE,RECORDING,VOICE,ATTACHMENT,VIDEO,FRIENDS,SYSTEM
 
 from requests.exceptions import MissingSchema
-from .bus import MessageBus, MsgDirection
+from .bus import MessageBus, MsgDirection, get_message_bus
 from .base import BaseBotInstance, EmptyBot
 from .models import Message, ChannelType, MessageType
 from .helpers import get_now_date_time, get_logger
@@ -170,8 +170,6 @@ def wxdebug():
 class WechatHandle(BaseBotInstance):
 
     ChanTag = ChannelType.Wechat
-    SupportMultiline = True
-    SupportPhoto = True
 
     def __init__(self, roomNicks):
         global wxRooms, myUid
@@ -225,7 +223,8 @@ def Fishroom2WechatThread(wx: WechatHandle, bus: MessageBus):
     if wx is None or isinstance(wx, EmptyBot):
         logger.info("Error creating Fishroom2WechatThread")
         return
-    for msg in bus.message_stream():
+
+    def forward(msg, start_line=0):
         logger.info("message opt from bus is: " + str(msg.opt))
         myid_chn = config[msg.channel].get("me")
 
@@ -235,7 +234,9 @@ def Fishroom2WechatThread(wx: WechatHandle, bus: MessageBus):
         if myid_chn is not None and myid_chn == id_chn:
             logger.info("message from " + id_chn + ", setting sender to None.")
             msg.sender = None
-        wx.forward_msg_from_fishroom(msg)
+        wx.forward_msg_from_fishroom(msg, start_line)
+
+    wx.forward_msgs_from_bus(bus, forward)
 
 
 def init():
@@ -251,8 +252,9 @@ def init():
     elif provider == "qiniu":
         photo_store = get_qiniu(redis_client, config)
 
-    im2fish_bus = MessageBus(redis_client, MsgDirection.im2fish)
-    fish2im_bus = MessageBus(redis_client, MsgDirection.fish2im)
+    im2fish_bus = get_message_bus(redis_client, MsgDirection.im2fish)
+    fish2im_bus = get_message_bus(
+        redis_client, MsgDirection.fish2im, ChannelType.Wechat)
 
     roomNicks = [b["wechat"]
                 for _, b in config['bindings'].items() if "wechat" in b]
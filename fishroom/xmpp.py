@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 import sleekxmpp
-from .bus import MessageBus, MsgDirection
+from .bus import MessageBus, MsgDirection, get_message_bus
 from .base import BaseBotInstance, EmptyBot
 from .models import Message, ChannelType, MessageType
 from .helpers import get_now_date_time
@@ -87,15 +87,15 @@ def XMPP2FishroomThread(xmpp_handle: XMPPHandle, bus: MessageBus):
 def Fishroom2XMPPThread(xmpp_handle: XMPPHandle, bus: MessageBus):
     if xmpp_handle is None or isinstance(xmpp_handle, EmptyBot):
         return
-    for msg in bus.message_stream():
-        xmpp_handle.forward_msg_from_fishroom(msg)
+    xmpp_handle.forward_msgs_from_bus(bus)
 
 
 def init():
     from .db import get_redis
     redis_client = get_redis()
-    im2fish_bus = MessageBus(redis_client, MsgDirection.im2fish)
-    fish2im_bus = MessageBus(redis_client, MsgDirection.fish2im)
+    im2fish_bus = get_message_bus(redis_client, MsgDirection.im2fish)
+    fish2im_bus = get_message_bus(
+        redis_client, MsgDirection.fish2im, ChannelType.XMPP)
 
     rooms = [b["xmpp"] for _, b in config['bindings'].items() if "xmpp" in b]
     server = config['xmpp']['server']
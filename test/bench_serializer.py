@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+import sys
+import timeit
+from os.path import dirname
+sys.path.insert(0, dirname(dirname(__file__)))
+
+from fishroom.models import (
+    Message, ChannelType, RichText, TextStyle, Color
+)
+
+
+def rich_irc_message():
+    return Message(
+        ChannelType.IRC, "bigeagle", "#tuna", "errors: foo bar baz",
+        date="2017-01-01", time="12:00:00", room="tuna",
+        rich_text=RichText([
+            (TextStyle(), "bigeagle: "),
+            (TextStyle(color=Color(4)), "errors:"),
+            (TextStyle(bold=1), " foo"),
+            (TextStyle(color=Color(3, 5), italic=1), " bar"),
+            (TextStyle(underline=1), " baz"),
+        ]),
+        route={"irc": "#tuna", "telegram": "-1001", "xmpp": "tuna@muc"},
+    )
+
+
+def bench(number=20000):
+    m = rich_irc_message()
+    jstr = m.dumps()
+    results = {}
+    for validating in (True, False):
+        Message.validating = validating
+        # Message.dumps is memoized, time the serializer itself
+        dumps = timeit.timeit(m._dumps, number=number)
+        loads = timeit.timeit(lambda: Message.loads(jstr), number=number)
+        results[validating] = (dumps, loads)
+        print("{:<10} dumps: {:.2f}us loads: {:.2f}us".format(
+            "schema" if validating else "fast",
+            dumps * 1e6 / number, loads * 1e6 / number))
+    Message.validating = False
+
+    (sd, sl), (fd, fl) = results[True], results[False]
+    print("speedup    dumps: {:.1f}x loads: {:.1f}x".format(sd / fd, sl / fl))
+
+
+if __name__ == "__main__":
+    bench()
+
+# vim: ts=4 sw=4 sts=4 expandtab